@@ -1,4 +1,11 @@
 from .api import *
+from .cache import *
 from .db import *
+from .decode import *
+from .endpoints import *
+from .history import *
+from .retry import *
+from .rpc import *
+from .throttle import *
 from .utils import *
 from .domain import *
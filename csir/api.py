@@ -1,105 +1,340 @@
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
-from json import loads
-from re import sub
+from math import ceil
+from random import choices
+from re import match
+from threading import Lock
+from time import monotonic
 from urllib.parse import urljoin
 from datetime import datetime
 
-from requests import get
-
 from csir.domain import Block, Transaction
-from csir.utils import with_retries
+from csir.endpoints import Endpoint
+from csir.retry import RetryPolicy, ErrorResponse, parse_response
+from csir.utils import pooled_session
 
 
 class Api():
-    def __init__(self, lcd_base_url, debug=False):
+    health_check_interval = 30
+
+    # how many blocks an LCD can be behind the others and still be used
+    max_lag = 10
+
+    # the only parts of these responses we read (see Transaction),
+    # signatures, memos & raw logs are skipped while decoding
+    txs_fields = (
+        'error', 'height', 'page_number', 'page_total',
+        'txs.item.height',
+        'txs.item.txhash',
+        'txs.item.events',
+        'txs.item.logs.item.success',
+        'txs.item.tx.value.msg.item.type',
+    )
+    delegations_fields = ('error', 'height', 'result.item.delegator_address')
+
+    def __init__(self, lcd_base_url, block_store=None, cache=None, retry_policy=None, pool_size=10, budget=None, debug=False):
         self.debug = debug
-        self.lcd_base_url = sub('//$', '/', lcd_base_url+'/')
 
-    def _get(self, path, params=None, retries=5, handle_error_key=True):
+        # a semaphore shared with other Apis/Rpcs, capping their requests in flight
+        self.budget = budget
+        self.session = pooled_session(pool_size)
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        # one or more LCDs to spread requests over, as urls or Endpoints
+        urls = lcd_base_url if isinstance(lcd_base_url, (list, tuple)) else [lcd_base_url]
+        self.endpoints = [url if isinstance(url, Endpoint) else Endpoint(url) for url in urls]
+        self.__checked_at = None
+        self.__check_lock = Lock()
+
+        # a ResponseCache, for responses that can't change anymore
+        self.cache = cache
+
+        # anything with get_block, get_blocks_around & add_block, eg. Db
+        self.block_store = block_store
+
+    def _get(self, path, params=None, retries=5, handle_error_key=True, endpoint=None, fields=None):
+        cache_key = None
+        if self.cache and self._is_final(path, params):
+            cache_key = self.cache.key(path, params)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                if self.debug:
+                    print(f"CACHED: {path} {params}", flush=True)
+                return cached
+
+        tried = []
+
         def f():
+            # retries go to another LCD, if there is one
+            current = endpoint or self._pick_endpoint(exclude=tried)
+            tried.append(current)
+            url = urljoin(current.url, path)
+
             if self.debug:
-                print(f"REQ: {urljoin(self.lcd_base_url, path)} {params}", end='', flush=True)
+                print(f"REQ: {url} {params}", end='', flush=True)
                 pass
 
             start_time = datetime.now()
-            url = urljoin(self.lcd_base_url, path)
-            response = get(url, params, timeout=(3.1, 15))
-            json = loads(response.content)
+            throttle = current.throttle
+
+            # this LCD's slot & rate token first, so a request waiting on its own
+            # throttle doesn't hold a slot of the budget shared with other chains,
+            # timed from here so waiting on the budget doesn't count as latency
+            if throttle: throttle.acquire()
+            if self.budget: self.budget.acquire()
+            started_at = monotonic()
+            overloaded = False
+            try:
+                with self.session.get(url, params=params, timeout=(3.1, 15), stream=fields is not None) as response:
+                    json = parse_response(response, fields)
+            except Exception as error:
+                overloaded = self.retry_policy.is_retryable(error)
+                current.failed()
+                raise
+            finally:
+                if self.budget: self.budget.release()
+                if throttle: throttle.release(started_at, overloaded=overloaded)
 
             if handle_error_key and 'error' in json:
-                raise RuntimeError(f"ERROR making request: {url} with params {params} -> {json}")
+                raise ErrorResponse(f"ERROR making request: {url} with params {params} -> {json}")
+
+            current.succeeded(monotonic() - started_at)
 
             if self.debug:
-                print(f" (took {datetime.now() - start_time})", flush=True)
+                throttling = f", limit {throttle.limit:.1f}, avg {throttle.latency:.3f}s" if throttle and throttle.latency else ''
+                print(f" (took {datetime.now() - start_time}{throttling})", flush=True)
                 pass
 
             return json
 
-        return with_retries(f, retries)
+        json = self.retry_policy.run(f, retries, key=lambda: tried[-1].url)
+
+        # errors may be down to the node (eg. pruned heights), don't keep them
+        if cache_key and 'error' not in json:
+            self.cache.put(cache_key, json)
+
+        return json
+
+    def _pick_endpoint(self, exclude=()):
+        self.check_endpoints()
+
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        candidates = [endpoint for endpoint in healthy if endpoint not in exclude] or healthy or self.endpoints
+        if len(candidates) == 1: return candidates[0]
+
+        # faster LCDs get proportionally more requests, ones we
+        # haven't timed yet are treated as the fastest to try them out
+        latencies = [endpoint.latency for endpoint in candidates if endpoint.latency]
+        fastest = min(latencies) if latencies else 1
+        weights = [1 / (endpoint.latency or fastest) for endpoint in candidates]
+
+        return choices(candidates, weights)[0]
+
+    def check_endpoints(self, force=False):
+        if len(self.endpoints) < 2: return
+
+        # someone else is already checking
+        if not self.__check_lock.acquire(blocking=False): return
+
+        try:
+            if not force and self.__checked_at and \
+               monotonic() - self.__checked_at < self.__class__.health_check_interval:
+                return
+            self.__checked_at = monotonic()
+
+            for endpoint in self.endpoints:
+                try:
+                    endpoint.height = Block(self._get('blocks/latest', retries=1, endpoint=endpoint)).height
+                except:
+                    endpoint.height = None
+
+            heights = [endpoint.height for endpoint in self.endpoints if endpoint.height is not None]
+            best_height = max(heights) if heights else None
+
+            for endpoint in self.endpoints:
+                endpoint.healthy = endpoint.height is not None and \
+                                   endpoint.height >= best_height - self.__class__.max_lag
+                if endpoint.healthy: endpoint.failures = 0
+
+                if self.debug:
+                    print(f"\tLCD {endpoint.url} at {endpoint.height}, {'healthy' if endpoint.healthy else 'unhealthy'}", flush=True)
+        finally:
+            self.__check_lock.release()
+
+    def _is_final(self, path, params):
+        # anything pinned to a specific height won't change anymore
+        height = (params or {}).get('height')
+        if height is not None:
+            return str(height) != 'latest'
+        return match(r'blocks/\d+$', path) is not None
 
     def get_chain(self):
-        return self._get('node_info')['node_info']['network']
+        # LCDs that are down are left to the health checks, as long as one answers
+        networks = set()
+        for endpoint in self.endpoints:
+            try:
+                networks.add(self._get('node_info', endpoint=endpoint)['node_info']['network'])
+            except Exception as error:
+                if len(self.endpoints) < 2: raise
+                endpoint.healthy = False
+                last_error = error
+
+                if self.debug:
+                    print(f"\tLCD {endpoint.url} unreachable: {error}", flush=True)
+
+        if not networks: raise last_error
+        if len(networks) > 1:
+            raise RuntimeError(f"LCDs are on different chains: {', '.join(sorted(networks))}")
+        return networks.pop()
 
     def get_block(self, height_or_latest='latest'):
-        data = self._get(f"blocks/{height_or_latest}")
-        return Block(data)
+        if self.block_store and height_or_latest != 'latest':
+            known = self.block_store.get_block(height_or_latest)
+            if known: return known
 
-    def get_block_closest_to(self, target_time, start_height):
-        offset = 0
-        direction = None
+        block = Block(self._get(f"blocks/{height_or_latest}"))
+        if self.block_store:
+            self.block_store.add_block(block.height, block.timestamp)
 
-        while True:
-            current_block = self.get_block(start_height + offset)
+        return block
 
-            # went past head or something else went wrong?
-            if current_block is None: raise
+    def get_block_closest_to(self, target_time, start_height, head=None):
+        # finds the first block at or after target_time by interpolating on
+        # block times, falling back to bisection when block times drift
 
-            if direction is None:
-                direction = +1 if current_block.timestamp < target_time else -1
+        # lower is always before target_time, upper is always at or after it
+        lower, upper = None, None
+        checked = 0
 
-            if current_block.timestamp == target_time or \
-               (current_block.timestamp > target_time and direction == +1) or \
-               (current_block.timestamp < target_time and direction == -1):
-                if self.debug:
-                    print(f"\tFound block {current_block.height} after checking {offset} from starting point", flush=True)
-                return current_block
+        # start from the closest blocks we've already seen, if any
+        if self.block_store:
+            lower, upper = self.block_store.get_blocks_around(target_time)
+
+        if upper is None:
+            head = head or self.get_block('latest')
+            if head.timestamp < target_time:
+                raise RuntimeError(f"No block at or after {target_time} yet, head is {head.height} at {head.timestamp}")
+            upper = head
+
+        def check(height):
+            nonlocal lower, upper, checked
+            block = self.get_block(height)
+            checked += 1
+
+            if self.debug:
+                print(f"\t{block.height}'s time of {block.timestamp} ~ {target_time}", flush=True)
+
+            if block.timestamp < target_time:
+                lower = block
             else:
-                if self.debug:
-                    print(f"\t{current_block.height}'s time of {current_block.timestamp} !~ {target_time}", flush=True)
-                pass
+                upper = block
+
+        if lower is None and start_height < upper.height:
+            check(max(start_height, 1))
 
-            offset += direction
+        # step back until we're before target_time, starting with
+        # how many blocks away it should be at the chain's average rate
+        step = 1
+        if head and upper.height < head.height:
+            seconds_per_block = (head.timestamp - upper.timestamp) / (head.height - upper.height)
+            step = max(1, int((upper.timestamp - target_time) / seconds_per_block))
 
-    def get_transactions(self, query):
-        txs = []
-        page = 1
+        while lower is None:
+            if upper.height == 1: break
+            check(max(1, upper.height - step))
+            step *= 2
+
+        bisect = False
+        while lower is not None and upper.height - lower.height > 1:
+            span = upper.height - lower.height
+
+            if bisect:
+                height = lower.height + span // 2
+            else:
+                fraction = (target_time - lower.timestamp) / (upper.timestamp - lower.timestamp)
+                height = lower.height + ceil(fraction * span)
+
+            check(min(max(height, lower.height + 1), upper.height - 1))
+
+            # interpolating didn't at least halve the range, bisect next
+            bisect = not bisect and (upper.height - lower.height) * 2 > span
+
+        if self.debug:
+            print(f"\tFound block {upper.height} after checking {checked} blocks", flush=True)
+
+        return upper
+
+    def get_transactions(self, query, min_height=None, max_height=None, reverse=False):
+        # lazy, a page at a time, so long histories never sit in memory at once.
+        # pages are ordered by height, so paging stops once it's past the window
+        for _, txs_page in self.get_transaction_pages(query, reverse=reverse):
+            for tx in (reversed(txs_page) if reverse else txs_page):
+                if min_height is not None and tx.height < min_height:
+                    if reverse: return
+                    continue
+                if max_height is not None and tx.height > max_height:
+                    if not reverse: return
+                    continue
+                yield tx
+
+    def get_transaction_pages(self, query, page=1, limit=None, reverse=False):
+        # pages are ordered by height, so with a fixed limit a page
+        # number keeps pointing at the same transactions over time
+        query = dict(query)
+        if limit: query['limit'] = limit
+
+        if reverse:
+            yield from self.__get_transaction_pages_reversed(query, page)
+            return
 
         while True:
             query['page'] = page
-            txsr = self._get('txs', query)
-            txs.extend(txsr['txs'])
+            txsr = self._get('txs', query, fields=self.__class__.txs_fields)
+            yield page, list(map(lambda tx: Transaction(tx), txsr['txs'] or []))
             if int(txsr['page_number']) >= int(txsr['page_total']): break
             page += 1
 
-        return list(map(lambda tx: Transaction(tx), txs))
+    def __get_transaction_pages_reversed(self, query, last_page):
+        # newest first, from page_total back down to last_page, the
+        # first request is only there to find out how many pages there are
+        query['page'] = last_page
+        first = self._get('txs', query, fields=self.__class__.txs_fields)
+        page_total = max(int(first['page_total']), last_page)
 
-    def discover_delegators_at_height(self, height):
+        for page in range(page_total, last_page, -1):
+            query['page'] = page
+            txsr = self._get('txs', query, fields=self.__class__.txs_fields)
+            yield page, list(map(lambda tx: Transaction(tx), txsr['txs'] or []))
+
+        yield last_page, list(map(lambda tx: Transaction(tx), first['txs'] or []))
+
+    def discover_delegators_at_height(self, height, concurrency=1):
         validators_at_height = self.get_validators_at_height(height)
-        for validator in sorted(validators_at_height):
-            delegators_at_height = self.get_delegators_at_height(validator, height)
-            for delegator in delegators_at_height: yield delegator
+        seen = set()
 
-    def get_validators_at_height(self, height):
-        bonded = self._get('staking/validators', {'status': 'bonded', 'height': height})
-        unbonding = self._get('staking/validators', {'status': 'unbonding', 'height': height})
-        unbonded = self._get('staking/validators', {'status': 'unbonded', 'height': height})
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            delegators_by_validator = executor.map(
+                lambda validator: self.get_delegators_at_height(validator, height),
+                sorted(validators_at_height)
+            )
 
-        flattened = chain(*map(lambda r: r['result'], [bonded, unbonding, unbonded]))
-        return set(map(lambda v: v['operator_address'], flattened))
+            for delegators_at_height in delegators_by_validator:
+                for delegator in sorted(delegators_at_height - seen): yield delegator
+                seen |= delegators_at_height
+
+    def get_validators_at_height(self, height):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            responses = executor.map(
+                lambda status: self._get('staking/validators', {'status': status, 'height': height}),
+                ('bonded', 'unbonding', 'unbonded')
+            )
+            flattened = chain(*map(lambda r: r['result'], responses))
+            return set(map(lambda v: v['operator_address'], flattened))
 
     def get_delegators_at_height(self, validator, height):
-        bonded = self._get(f"staking/validators/{validator}/delegations", {'height': height})
-        unbonding = self._get(f"staking/validators/{validator}/unbonding_delegations", {'height': height})
+        fields = self.__class__.delegations_fields
+        bonded = self._get(f"staking/validators/{validator}/delegations", {'height': height}, fields=fields)
+        unbonding = self._get(f"staking/validators/{validator}/unbonding_delegations", {'height': height}, fields=fields)
         flattened = chain(*map(lambda r: r['result'] or [], [bonded, unbonding]))
         return set(map(lambda d: d['delegator_address'], flattened))
 
@@ -119,3 +354,4 @@ class Api():
         r = self._get(f"distribution/validators/{operator_address}", {'height': height}, handle_error_key=False)
         if 'error' in r: return None
         return r['result']
+
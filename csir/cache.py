@@ -0,0 +1,93 @@
+from json import loads, dumps
+from sqlite3 import connect
+from threading import Lock
+from time import time
+
+
+class ResponseCache():
+    def __init__(self, path, max_size, debug=False):
+        self.debug = debug
+        self.max_size = max_size
+
+        # shared by every api worker thread, a cache can
+        # afford to lose its last writes in a crash
+        self.__lock = Lock()
+        self.__conn = connect(path, isolation_level=None, check_same_thread=False)
+        self.__conn.execute('PRAGMA journal_mode = WAL;')
+        self.__conn.execute('PRAGMA synchronous = NORMAL;')
+        self.__conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body TEXT,
+                size INTEGER,
+                used_at REAL
+            );
+        ''')
+        self.__conn.execute('''
+            CREATE INDEX IF NOT EXISTS responses_used_at
+            ON responses (used_at);
+        ''')
+
+        self.__size = self.__conn.execute('''
+            SELECT COALESCE(SUM(size), 0) FROM responses;
+        ''').fetchone()[0]
+
+    @staticmethod
+    def key(path, params):
+        return f"{path} {dumps(params or {}, sort_keys=True)}"
+
+    def get(self, key):
+        with self.__lock:
+            row = self.__conn.execute('''
+                SELECT body FROM responses
+                WHERE key = ?;
+            ''', (key,)).fetchone()
+            if row is None: return None
+
+            self.__conn.execute('''
+                UPDATE responses
+                SET used_at = ?
+                WHERE key = ?;
+            ''', (time(), key))
+
+        return loads(row[0])
+
+    def put(self, key, json):
+        body = dumps(json)
+
+        with self.__lock:
+            previous = self.__conn.execute('''
+                SELECT size FROM responses
+                WHERE key = ?;
+            ''', (key,)).fetchone()
+
+            self.__conn.execute('''
+                INSERT OR REPLACE INTO responses(key, body, size, used_at)
+                VALUES (?, ?, ?, ?);
+            ''', (key, body, len(body), time()))
+            self.__size += len(body) - (previous[0] if previous else 0)
+
+            if self.__size > self.max_size: self.__evict()
+
+    def __evict(self):
+        # drop least recently used responses until we're 10% under the limit
+        target_size = self.max_size * 0.9
+        rows = self.__conn.execute('''
+            SELECT key, size FROM responses
+            ORDER BY used_at ASC;
+        ''')
+
+        evicted = []
+        for key, size in rows:
+            if self.__size <= target_size: break
+            evicted.append((key,))
+            self.__size -= size
+        rows.close()
+
+        self.__conn.executemany('''
+            DELETE FROM responses
+            WHERE key = ?;
+        ''', evicted)
+
+        if self.debug:
+            print(f"\tCACHE: evicted {len(evicted)} responses", flush=True)
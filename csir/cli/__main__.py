@@ -4,10 +4,22 @@ from os import makedirs
 from signal import signal, SIGINT
 from sys import exit, argv
 
-from csir import Api, Db
+from csir import Api, Db, Endpoint, Rpc, ResponseCache, RetryPolicy, Throttle
 from .reporter import Reporter
 from .utils import account_discoverer, accounts_to_run, \
-                   setup_runs, export_csvs
+                   setup_runs, export_csvs, export_consolidated, \
+                   export_rollups
+
+
+default_db_path = abspath(join(dirname(__file__), '..', '..', 'db'))
+default_lcd_url = 'http://localhost:1317'
+default_scale = 6
+default_cache_size = 1024
+valid_networks = (
+    'cosmos',
+    'kava',
+    'terra',
+)
 
 
 def main(args=None):
@@ -15,37 +27,67 @@ def main(args=None):
 
     signal(SIGINT, lambda sig, frame: exit(0))
 
-    default_db_path = abspath(join(dirname(__file__), '..', '..', 'db'))
-    default_lcd_url = 'http://localhost:1317'
-    default_scale = 6
-    valid_networks = (
-        'cosmos',
-        'kava',
-        'terra',
-    )
+    run(parse_args(args))
+
 
+def build_parser():
     parser = ArgumentParser(prog='cosmos-sdk-income-reports', description='Cosmos-SDK Income Reports CLI')
     parser.add_argument('--network', required=True, choices=valid_networks, help=f"Type of network")
-    parser.add_argument('--denom', required=True, help='Token denomination to calculate rewards for')
+    parser.add_argument('--denom', dest='denoms', metavar='DENOM', required=True, action='append', help='Token denomination to calculate rewards for, repeat to record several from the same requests')
     parser.add_argument('--scale', default=default_scale, type=int, help=f"Power of 10 to scale the numbers in reports by (default {default_scale})")
     parser.add_argument('--db-path', default=default_db_path, help=f"Directory for sqlite3 db (default {default_db_path})")
+    parser.add_argument('--wal', action='store_true', default=False, help='Use sqlite\'s write-ahead log for the db, so it can be read (eg. exported) while a run is writing')
+    parser.add_argument('--cache-size', default=default_cache_size, type=int, help=f"Megabytes of finalised LCD responses to keep in --db-path, 0 to disable (default {default_cache_size})")
     parser.add_argument('--csv-path', default=None, help='Path to export CSVs, omit to skip generating CSV reports')
-    parser.add_argument('--lcd-url', default=default_lcd_url, help=f"Accessible light client daemon (default {default_lcd_url})")
+    parser.add_argument('--report', choices=('daily', 'monthly', 'yearly'), default='daily', help='Export daily reports, or income & withdrawals per month or year for every account into one CSV (default daily)')
+    parser.add_argument('--csv-format', choices=('files', 'csv', 'ndjson'), default='files', help='Export a CSV file per account, or every account in one CSV or NDJSON file (default files)')
+    parser.add_argument('--csv-gzip', action='store_true', default=False, help='Gzip the single --csv-format csv/ndjson file')
+    parser.add_argument('--incremental-csvs', action='store_true', default=False, help='Only append new lines to CSVs exported before, rewriting the ones with older lines added since')
+    parser.add_argument('--lcd-url', dest='lcd_urls', metavar='LCD_URL', action='append', default=None, help=f"Accessible light client daemon, repeat to spread requests over several (default {default_lcd_url})")
+    parser.add_argument('--rpc-url', default=None, help='Accessible tendermint RPC server, required for --tx-source rpc/blocks')
+    parser.add_argument('--tx-source', choices=('lcd', 'rpc', 'blocks'), default='lcd', help='Where to look up withdrawal transactions: per account from the LCD, per account & run window from the RPC, or by scanning every block of a run once through the RPC (default lcd)')
     parser.add_argument('--account', dest='whitelist', metavar='ADDRESS', action='append', default=None, help='Accounts to exclusively run reports for')
     parser.add_argument('--skip', dest='blacklist', metavar='ADDRESS', action='append', default=[], help='Accounts to never run reports for')
     parser.add_argument('--start-at', choices=('genesis', 'latest-run'), default='latest-run', help='Consider every report window from genesis, or just from the latest completed run')
+    parser.add_argument('--concurrency', default=1, type=int, help='Number of accounts (or validators during discovery) to fetch at once (default 1)')
+    parser.add_argument('--run-concurrency', default=1, type=int, help='Number of report runs to process at once, sharing --concurrency (default 1)')
+    parser.add_argument('--max-rate', default=None, type=float, help='Maximum requests per second per LCD, concurrency adapts to each LCD\'s health below --concurrency (default unlimited)')
+    parser.add_argument('--retry-budget', default=None, type=int, help='Maximum retried requests per report run before giving up on it (default unlimited)')
     parser.add_argument('--force-account-discovery', action='store_true', default=False, help='Account discovery is skipped on subsequent runs, force with this flag')
     parser.add_argument('--debug', action='store_true', default=False, help='Development mode (default false)')
-    args = parser.parse_args()
+    return parser
+
+
+def parse_args(args, parser=None):
+    parser = parser or build_parser()
+    args = parser.parse_args(args)
 
-    api = Api(args.lcd_url, debug=args.debug)
+    if args.tx_source in ('rpc', 'blocks') and args.rpc_url is None:
+        parser.error(f"--tx-source {args.tx_source} requires --rpc-url")
+
+    return args
+
+
+def run(args, budget=None):
+    # enough pooled connections for every worker
+    pool_size = max(10, args.concurrency)
+    endpoints = [
+        Endpoint(url, throttle=Throttle(max_concurrency=args.concurrency, max_rate=args.max_rate))
+        for url in (args.lcd_urls or [default_lcd_url])
+    ]
+    retry_policy = RetryPolicy(budget=args.retry_budget)
+    api = Api(endpoints, retry_policy=retry_policy, pool_size=pool_size, budget=budget, debug=args.debug)
+    rpc = Rpc(args.rpc_url, retry_policy=retry_policy, pool_size=pool_size, budget=budget, debug=args.debug) if args.rpc_url else None
     chain = api.get_chain()
 
     makedirs(args.db_path, exist_ok=True)
-    db = Db(join(args.db_path, f"{chain}.db"), args.denom, args.scale, debug=args.debug)
+    db = Db(join(args.db_path, f"{chain}.db"), args.denoms, args.scale, wal=args.wal, debug=args.debug)
+    api.block_store = db
+    if args.cache_size > 0:
+        api.cache = ResponseCache(join(args.db_path, f"{chain}-cache.db"), args.cache_size * 1024**2, debug=args.debug)
 
-    reporter = Reporter(db, api, args.network, args.denom, debug=args.debug)
-    discoverer = account_discoverer(api, args.force_account_discovery, args.whitelist)
+    reporter = Reporter(db, api, args.network, args.denoms, rpc=rpc, tx_source=args.tx_source, concurrency=args.concurrency, run_concurrency=args.run_concurrency, debug=args.debug)
+    discoverer = account_discoverer(api, args.force_account_discovery, args.whitelist, concurrency=args.concurrency)
 
     latest_run = setup_runs(db, api, args.start_at, discoverer, debug=args.debug)
     accounts = list(filter(
@@ -56,10 +98,20 @@ def main(args=None):
     runs = db.get_runs(after=latest_run)
     reporter.calculate_income_for(accounts, runs)
 
-    if len(runs) > 0 and args.csv_path:
+    # rollups are cheap to export, even when there weren't any new runs
+    if args.csv_path and (len(runs) > 0 or args.report != 'daily'):
         csv_path = join(args.csv_path, chain)
         makedirs(csv_path, exist_ok=True)
-        export_csvs(db, csv_path, args.denom, accounts)
+        for denom in args.denoms:
+            if args.report != 'daily':
+                export_rollups(db, csv_path, denom, accounts, {'monthly': 'month', 'yearly': 'year'}[args.report])
+            elif args.csv_format == 'files':
+                export_csvs(db, csv_path, denom, accounts, incremental=args.incremental_csvs, concurrency=args.concurrency)
+            else:
+                export_consolidated(db, csv_path, denom, accounts, format=args.csv_format, compress=args.csv_gzip)
         print('\n')
 
+    return chain
+
+
 if __name__ == '__main__': main()
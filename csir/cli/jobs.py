@@ -0,0 +1,159 @@
+from argparse import ArgumentParser
+from datetime import datetime
+from json import load
+from os import makedirs
+from os.path import join
+from re import split
+from signal import signal, SIGINT
+from sys import exit, argv
+from shutil import get_terminal_size
+from threading import BoundedSemaphore, Thread, get_ident
+from traceback import print_exc
+import sys
+
+from .__main__ import build_parser, parse_args, run, default_db_path
+
+
+class Job():
+    def __init__(self, name, args, log_path):
+        self.name = name
+        self.args = args
+        self.log_path = log_path
+
+        self.status = 'waiting'
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.chain = None
+
+        self.__log = None
+        self.__line = ''
+
+    def run(self, budget, output):
+        output.jobs[get_ident()] = self
+        self.started_at = datetime.now()
+        self.status = 'starting'
+        with open(self.log_path, 'w') as log:
+            self.__log = log
+            try:
+                self.chain = run(self.args, budget=budget)
+                self.status = 'done'
+            except BaseException as error:
+                print_exc(file=log)
+                self.error = error
+                self.status = 'failed'
+            finally:
+                self.__log = None
+                self.finished_at = datetime.now()
+
+    def write(self, text):
+        if self.__log: self.__log.write(text)
+
+        # the latest line (or \r progress update) is the job's status
+        parts = split(r'[\r\n]', self.__line + text)
+        self.__line = parts[-1]
+        latest = next((part.strip() for part in reversed(parts) if part.strip()), None)
+        if latest: self.status = latest
+
+    def flush(self):
+        if self.__log: self.__log.flush()
+
+    def elapsed(self):
+        if self.started_at is None: return None
+        return (self.finished_at or datetime.now()) - self.started_at
+
+
+class JobOutput():
+    # stands in for stdout, so each job's prints go to its own log,
+    # anything printed from other threads (eg. --debug) goes through as is
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.jobs = {}
+
+    def write(self, text):
+        job = self.jobs.get(get_ident())
+        if job is None: return self.stdout.write(text)
+        job.write(text)
+
+    def flush(self):
+        job = self.jobs.get(get_ident())
+        if job is None: return self.stdout.flush()
+        job.flush()
+
+
+def main(args=None):
+    if args is None: args = argv[1:]
+
+    signal(SIGINT, lambda sig, frame: exit(0))
+
+    parser = ArgumentParser(prog='cosmos-sdk-income-reports-jobs', description='Runs several Cosmos-SDK Income Reports CLI jobs at once')
+    parser.add_argument('config', help='JSON file with a list of "jobs", each with the CLI\'s options (eg. {"network": "cosmos", "lcd-url": [...], "denom": [...]}) & an optional "name"')
+    parser.add_argument('--concurrency', default=None, type=int, help='Requests in flight across all jobs, overrides the config\'s "concurrency" (default 10)')
+    parser.add_argument('--log-path', default=default_db_path, help=f"Directory for each job's output (default {default_db_path})")
+    args = parser.parse_args(args)
+
+    with open(args.config) as f: config = load(f)
+    concurrency = args.concurrency or config.get('concurrency') or 10
+
+    makedirs(args.log_path, exist_ok=True)
+    jobs = []
+    for index, options in enumerate(config['jobs']):
+        options = dict(options)
+        name = options.pop('name', None) or f"{options.get('network', 'job')}-{index+1}"
+
+        # each job may use the whole budget while the others are idle
+        options.setdefault('concurrency', concurrency)
+        job_args = parse_args(cli_args(options), build_parser())
+        jobs.append(Job(name, job_args, join(args.log_path, f"{name}.log")))
+
+    run_jobs(jobs, BoundedSemaphore(concurrency))
+
+    if any(job.error for job in jobs): exit(1)
+
+
+def cli_args(options):
+    # {'lcd-url': ['a', 'b'], 'wal': True} -> ['--lcd-url', 'a', '--lcd-url', 'b', '--wal']
+    args = []
+    for key, value in options.items():
+        flag = '--' + key.replace('_', '-')
+        if value is True:
+            args.append(flag)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, (list, tuple)):
+            for item in value: args.extend((flag, str(item)))
+        else:
+            args.extend((flag, str(value)))
+    return args
+
+
+def run_jobs(jobs, budget, interval=1):
+    start_time = datetime.now()
+    print(f"Running {len(jobs)} jobs, logging to {', '.join(job.log_path for job in jobs)}", flush=True)
+
+    output = JobOutput(sys.stdout)
+    sys.stdout = output
+    threads = []
+    try:
+        for job in jobs:
+            thread = Thread(target=job.run, args=(budget, output), name=job.name, daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        # one combined progress line for every job
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads: thread.join(interval / len(threads))
+            width = get_terminal_size().columns - 1
+            progress = ' | '.join(f"{job.name}: {job.status}" for job in jobs)
+            output.stdout.write(f"\r{progress[:width].ljust(width)}")
+            output.stdout.flush()
+    finally:
+        sys.stdout = output.stdout
+
+    print(f"\n\nJobs complete in {datetime.now() - start_time}", flush=True)
+    for job in jobs:
+        result = f"failed: {job.error!r}" if job.error else 'done'
+        print(f"\t{job.name} ({job.chain or '?'}): {result} in {job.elapsed()}", flush=True)
+
+
+if __name__ == '__main__': main()
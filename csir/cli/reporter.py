@@ -1,7 +1,13 @@
+from collections import Counter
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait, FIRST_COMPLETED
+from queue import Queue, Empty, Full
 from re import search
 from itertools import chain
+from threading import Event
 from datetime import datetime
 
+from csir import TransactionHistory
 from csir.utils import encode_bech32, decode_bech32
 
 
@@ -12,133 +18,402 @@ class Reporter():
         'terra': 'terravaloper',
     }
 
-    def __init__(self, db, api, network, denom, debug=False):
+    def __init__(self, db, api, network, denoms, rpc=None, tx_source='lcd', concurrency=1, run_concurrency=1, debug=False):
         self.debug = debug
 
         self.db = db
         self.api = api
+        self.rpc = rpc
         self.network = network
-        self.denom = denom
+        # every denom comes out of the same responses, so they're all recorded at once
+        self.denoms = list(denoms) if isinstance(denoms, (list, tuple)) else [denoms]
+        self.tx_source = tx_source
+        self.concurrency = concurrency
+        self.run_concurrency = run_concurrency
+
+        self.__tx_histories = {}
+        self.__tx_sync_height = 0
+
+        # fetched tx pages on their way to this thread's db, see _page_store
+        self.__pages = Queue(maxsize=max(2, concurrency * 2))
+        self.__stopped = Event()
 
     def calculate_income_for(self, accounts, runs):
-        for run in runs:
+        # every run in this batch is at or below the chain head at this point,
+        # so syncing an account's tx history once covers the whole batch
+        self.__tx_sync_height = max(map(lambda run: run.height, runs), default=0)
+        self.__stopped.clear()
+
+        # accounts are fetched concurrently, for up to run_concurrency runs
+        # at once, but everything touching the db stays on this thread
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            waiting = list(runs)
+            active = []
+            run = None
             try:
-                start_time = datetime.now()
-                print(f"\nReport run for {run.target_timestamp} (height {run.height})...", flush=True)
+                # runs at once can't take turns extending tx histories, sync them
+                # up front so every run's withdrawals can be summed from the db,
+                # failing that fails the first run
+                if self.tx_source == 'lcd' and self.run_concurrency > 1 and len(runs) > 1:
+                    run = runs[0]
+                    self._sync_tx_histories(executor, accounts)
 
-                # get the accounts we should run a report for
-                accounts_for_run = self._filter_accounts_for_run(accounts, run)
-                count = len(accounts_for_run)
+                while waiting or active:
+                    while waiting and len(active) < self.run_concurrency:
+                        run = waiting.pop(0)
+                        active.append(self._start_run(executor, accounts, run))
 
-                for index, account in enumerate(accounts_for_run):
-                    status_line = f"\r{account.address} ({str(index+1).rjust(len(str(count)))}/{count})"
-                    print(f"{status_line} ", end='', flush=True)
+                    # only the earliest run in flight writes its reports, so a failed run
+                    # is never left with reports at later heights (see _filter_accounts_for_run)
+                    run = active[0].run
+                    self._write_reports(active[0])
 
-                    prev_run = self.db.get_previous_run(run)
+                    remaining = set(chain(*map(lambda state: state.remaining | state.scanning, active)))
+                    if remaining:
+                        done = self._wait(remaining)
+                        for state in active:
+                            run = state.run
+                            self._collect(state, done)
+                        self._print_progress(active)
 
-                    def step_callback(x):
-                        if self.debug: return
-                        print(
-                            f"{status_line} {'.' * x}{' ' * (len('DONE')-x)}",
-                            end='', flush=True
-                        )
+                    # runs are completed in height order, so a later run is never
+                    # marked OK while an earlier one could still fail
+                    while active and active[0].done():
+                        run = active[0].run
+                        self._finish_run(active.pop(0))
+            except Exception:
+                # like one run after another, runs after a failed one are left
+                # RUNNING with their reports discarded, while earlier ones
+                # already in flight still complete
+                earlier = list(filter(lambda state: state.run.height < run.height, active))
+                for state in active:
+                    if state not in earlier: state.cancel()
 
-                    report = self._generate_for(
-                        account.address,
-                        run,
-                        prev_run,
-                        step_callback=step_callback
-                    )
+                self.db.run_error(run)
+                for index, state in enumerate(earlier):
+                    try:
+                        while not state.done(): self._collect(state, self._wait(state.remaining | state.scanning))
+                        self._finish_run(state)
+                    except BaseException as error:
+                        for state in earlier[index:]: state.cancel()
+                        self.db.run_error(earlier[index].run)
+                        if not isinstance(error, Exception): raise
+                        break
+                raise
+            except BaseException:
+                # interrupted (eg. SIGINT's exit), don't wait on anything else
+                for state in active: state.cancel()
+                if run is not None: self.db.run_error(run)
+                raise
+            finally:
+                # workers still fetching give up instead of waiting on us
+                self.__stopped.set()
 
-                    self.db.insert_report(account.address, run, report)
-                    print(f"{status_line} DONE", end='', flush=True)
+    def _start_run(self, executor, accounts, run):
+        print(f"\nReport run for {run.target_timestamp} (height {run.height})...", flush=True)
 
-                self.db.run_ok(run)
+        # get the accounts we should run a report for
+        accounts_for_run, needing_report = self._filter_accounts_for_run(accounts, run)
+        state = RunState(run, self.db.get_previous_run(run), needing_report, len(accounts_for_run))
 
-                if count > 0:
-                    print(f"\nRun complete in {datetime.now() - start_time}", flush=True)
-                else:
-                    print("Nothing to do...", flush=True)
+        # each run has its own retry budget & counts, see _for_run
+        state.retries = [(policy, policy.start_run()) for policy in self._retry_policies()]
 
-            except:
-                self.db.run_error(run)
-                raise
+        # one pass over the run's blocks covers every account at once
+        if self.tx_source == 'blocks' and state.count > 0:
+            addresses = frozenset(map(lambda account: account.address, accounts_for_run))
+            start_height = state.prev_run.height + 1 if state.prev_run else 1
+            state.scanning = set(
+                executor.submit(self._for_run, state, self._scan_block, addresses, height)
+                for height in range(start_height, run.height + 1)
+            )
+            state.blocks = len(state.scanning)
 
-    def _filter_accounts_for_run(self, accounts, run):
-        def f(account):
-            # this address was first seen after this report height
-            if run and account.first_seen_height > run.height:
-                return False
+        for account in accounts_for_run:
+            history = self._get_tx_history(account.address) if self.tx_source == 'lcd' else None
+            future = executor.submit(self._for_run, state, self._generate_for, account.address, run, state.prev_run, history)
+            state.futures[future] = (account.address, history)
+
+        state.remaining = set(state.futures)
+        return state
+
+    def _wait(self, futures):
+        # stores fetched tx pages while waiting, so workers are never held up for long
+        while futures:
+            done, _ = wait(futures, timeout=0.1, return_when=FIRST_COMPLETED)
+            self._store_pages()
+            if done: return done
+        return set()
+
+    def _collect(self, state, done):
+        for future in state.scanning & done:
+            state.scanning.discard(future)
+            self._merge_withdrawals(state, future.result())
+        for future in state.remaining & done:
+            state.remaining.discard(future)
+            state.fetched.append(future)
+
+        # scanned withdrawals are only complete once every block is in
+        if not state.scanning:
+            for future in state.fetched: self._record_report(state, future)
+            state.fetched = []
+
+    def _record_report(self, state, future):
+        address, history = state.futures[future]
+        report, fetched = future.result()
+
+        if history is not None:
+            report['withdrawals'] = self._get_stored_withdrawals(
+                history, fetched, state.run, state.prev_run
+            )
+        elif self.tx_source == 'blocks':
+            scanned = state.scanned_withdrawals.get(address, {})
+            report['withdrawals'] = dict((denom, scanned.get(denom, 0)) for denom in self.denoms)
+
+        # amounts are by denom, only record denoms still missing a report
+        for denom in self.denoms:
+            if address not in state.needing_report[denom]: continue
+            values = dict((key, amounts[denom]) for key, amounts in report.items())
+            if state.writing:
+                self.db.insert_report(address, state.run, values, denom)
+            else:
+                state.reports.append((address, values, denom))
+
+            if self.debug:
+                print(f"\t{address} {denom} PRew: {values['pending_rewards']}, PCom: {values['pending_commission']}, W: {values['withdrawals']}", flush=True)
+
+        state.completed += 1
+
+    def _print_progress(self, active):
+        completed = sum(map(lambda state: state.completed, active))
+        count = sum(map(lambda state: state.count, active))
+        elapsed = (datetime.now() - min(map(lambda state: state.start_time, active))).total_seconds()
+        runs = f" in {len(active)} runs" if len(active) > 1 else ''
+
+        blocks = sum(map(lambda state: state.blocks, active))
+        scanned = blocks - sum(map(lambda state: len(state.scanning), active))
+        scanning = f"Blocks {str(scanned).rjust(len(str(blocks)))}/{blocks}, " if scanned < blocks else ''
+
+        print(
+            f"\r{scanning}Accounts {str(completed).rjust(len(str(count)))}/{count}{runs} ({completed / max(elapsed, 0.001):.1f}/s)",
+            end='', flush=True
+        )
+
+    def _write_reports(self, state):
+        for address, values, denom in state.reports:
+            self.db.insert_report(address, state.run, values, denom)
+        state.reports = []
+        state.writing = True
+
+    def _finish_run(self, state):
+        self._write_reports(state)
+        self.db.run_ok(state.run)
+
+        if state.count > 0:
+            print(f"\nRun for {state.run.target_timestamp} complete in {datetime.now() - state.start_time}", flush=True)
+        else:
+            print(f"Nothing to do for {state.run.target_timestamp}...", flush=True)
+
+        retries = sum((retries.retries for _, retries in state.retries), Counter())
+        if retries:
+            print(f"Retries: {', '.join(f'{url} ({count})' for url, count in retries.most_common())}", flush=True)
+
+    def _for_run(self, state, f, *args):
+        # workers are shared by the runs in flight, retries count against the run they're for
+        with ExitStack() as stack:
+            for policy, retries in state.retries: stack.enter_context(policy.for_run(retries))
+            return f(*args)
+
+    def _sync_tx_histories(self, executor, accounts):
+        for policy in self._retry_policies(): policy.start_run()
+
+        histories = dict(
+            (executor.submit(history.fetch, self._page_store(history)), history)
+            for history in map(lambda account: self._get_tx_history(account.address), accounts)
+            if not history.covers(self.__tx_sync_height)
+        )
 
-            # already have a report at this height
-            if run and self.db.get_latest_report_height_for(account.address) >= run.height:
-                return False
+        count = len(histories)
+        remaining = set(histories)
+        try:
+            while remaining:
+                done = self._wait(remaining)
+                remaining -= done
+                for future in done:
+                    future.result()
+                    histories[future].synced(self.__tx_sync_height)
+                print(f"\rSyncing transaction histories {str(count - len(remaining)).rjust(len(str(count)))}/{count}", end='', flush=True)
+        except BaseException:
+            # the histories not fetched yet would only be waited on
+            for future in remaining: future.cancel()
+            raise
 
-            return True
+        if count > 0: print('', flush=True)
 
-        return list(filter(f, accounts))
+    def _page_store(self, history):
+        def store_page(txs, page, page_offset):
+            # blocks while this thread is behind, so only a few pages are ever in memory
+            while not self.__stopped.is_set():
+                try:
+                    return self.__pages.put((history, txs, page, page_offset), timeout=0.1)
+                except Full:
+                    pass
+            raise CancelledError(f"Stopped fetching transactions for {history.address}")
+        return store_page
 
-    def _generate_for(self, address, run, prev_run, step_callback=None):
-        if not self.debug and step_callback: step_callback(1)
+    def _store_pages(self):
+        while True:
+            try:
+                history, txs, page, page_offset = self.__pages.get_nowait()
+            except Empty:
+                return
+            history.store(txs, page, page_offset)
+
+    def _retry_policies(self):
+        policies = [self.api.retry_policy]
+        if self.rpc and self.rpc.retry_policy is not self.api.retry_policy:
+            policies.append(self.rpc.retry_policy)
+        return policies
+
+    def _filter_accounts_for_run(self, accounts, run):
+        # seen by this report height & without a report at it yet, for any denom
+        needing_report = dict(
+            (denom, self.db.get_addresses_needing_report_at(run.height, denom))
+            for denom in self.denoms
+        )
+        needing_any = set().union(*needing_report.values())
+        return list(filter(lambda account: account.address in needing_any, accounts)), needing_report
+
+    def _generate_for(self, address, run, prev_run, history=None):
         pending = self._get_pending_rewards(address, run)
-        if not self.debug and step_callback: step_callback(2)
         commission = self._get_pending_commission(address, run)
-        if not self.debug and step_callback: step_callback(3)
-        withdrawals = self._get_withdrawals(address, run, prev_run)
-        if not self.debug and step_callback: step_callback(4)
 
-        if self.debug:
-            print(f"\t\tPRew: {pending}, PCom: {commission}, W: {withdrawals}", end='', flush=True)
+        # with a tx history only fetch here, the caller stores the new
+        # txs as they come & sums up withdrawals with _get_stored_withdrawals,
+        # scanned withdrawals are filled in by the caller too
+        fetched = False
+        withdrawals = None
+        if self.tx_source == 'rpc':
+            withdrawals = self._get_withdrawals(address, run, prev_run)
+        elif history is not None and not history.covers(run.height):
+            history.fetch(self._page_store(history))
+            fetched = True
+
         return {
             'pending_rewards': pending,
             'pending_commission': commission,
             'withdrawals': withdrawals
-        }
+        }, fetched
 
     def _get_pending_rewards(self, address, run):
-        reward_info = self.api.get_pending_rewards(address, run.height)
-        reward_info = reward_info or [{ 'amount': 0, 'denom': self.denom }]
-
-        relevant_reward = (list(filter(
-            lambda bal: bal['denom'] == self.denom,
-            reward_info
-        )) or [None])[0]
+        reward_info = self.api.get_pending_rewards(address, run.height) or []
 
-        if relevant_reward is None: return 0
-        return int(relevant_reward['amount'])
+        amounts = dict((denom, 0) for denom in self.denoms)
+        for reward in reward_info:
+            if reward['denom'] in amounts:
+                amounts[reward['denom']] = int(reward['amount'])
+        return amounts
 
     def _get_pending_commission(self, address, run):
         prefix = self.__class__.operator_prefix_by_network[self.network]
         operator = encode_bech32(prefix, decode_bech32(address)[1])
         validator_info = self.api.get_validator_distribution_info(operator, run.height)
-        if validator_info is None or validator_info.get('val_commission') is None: return 0
-        
-        relevant_commissions = list(filter(
-            lambda bal: bal['denom'] == self.denom,
-            validator_info['val_commission']
-        ))
-        
-        if len(relevant_commissions) == 0: return 0
-        relevant_commission = relevant_commissions[0]
-
-        return int(search(r'\d+', relevant_commission['amount']).group())
+
+        amounts = dict((denom, 0) for denom in self.denoms)
+        if validator_info is None or validator_info.get('val_commission') is None: return amounts
+
+        for commission in validator_info['val_commission']:
+            if commission['denom'] in amounts:
+                amounts[commission['denom']] = int(search(r'\d+', commission['amount']).group())
+        return amounts
 
     def _get_withdrawals(self, address, run, prev_run):
         start_height = prev_run.height + 1 if prev_run else 1
 
-        # TODO, when cosmos-sdk supports this, it's going to make
-        #       processing accounts with a lot of transactions a LOT easier
-        txs = self.api.get_transactions({
-            'transfer.recipient': address,
-            # 'tx.minheight': start_height,
-            # 'tx.maxheight': run.height
-        })
+        txs = self.rpc.get_transactions(
+            {'transfer.recipient': address},
+            min_height=start_height,
+            max_height=run.height
+        )
 
         txs = filter(
             lambda tx: tx.succeeded and \
-                       tx.is_between(start_height, run.height) and \
                        tx.is_reward_disbursement_type(self.network),
             txs
         )
 
-        return sum(map(lambda tx: tx.disbursement(address, self.denom), txs))
+        amounts = dict((denom, 0) for denom in self.denoms)
+        for tx in txs:
+            for denom in self.denoms:
+                amounts[denom] += tx.disbursement(address, denom)
+        return amounts
+
+    def _get_stored_withdrawals(self, history, fetched, run, prev_run):
+        start_height = prev_run.height + 1 if prev_run else 1
+
+        # its pages were all stored by _wait, before its report got here
+        if fetched:
+            history.synced(max(self.__tx_sync_height, run.height))
+
+        return self.db.get_withdrawals_by_denom(history.address, start_height, run.height)
+
+    def _get_tx_history(self, address):
+        history = self.__tx_histories.get(address)
+        if history is None:
+            history = TransactionHistory(self.api, self.db, address, self.network)
+            self.__tx_histories[address] = history
+        return history
+
+    def _scan_block(self, addresses, height):
+        txs = filter(
+            lambda tx: tx.succeeded and \
+                       tx.is_reward_disbursement_type(self.network),
+            self.rpc.get_block_transactions(height)
+        )
+
+        withdrawals = {}
+        for tx in txs:
+            for recipient, amounts in tx.transfers().items():
+                if recipient not in addresses: continue
+                totals = withdrawals.setdefault(recipient, {})
+                for denom in self.denoms:
+                    totals[denom] = totals.get(denom, 0) + amounts.get(denom, 0)
+        return withdrawals
+
+    def _merge_withdrawals(self, state, withdrawals):
+        for recipient, amounts in withdrawals.items():
+            totals = state.scanned_withdrawals.setdefault(recipient, {})
+            for denom, amount in amounts.items():
+                totals[denom] = totals.get(denom, 0) + amount
+
+class RunState():
+    # a report run's accounts in flight, see Reporter.calculate_income_for
+    def __init__(self, run, prev_run, needing_report, count):
+        self.run = run
+        self.prev_run = prev_run
+        self.needing_report = needing_report
+        self.count = count
+        self.start_time = datetime.now()
+
+        # blocks being scanned & withdrawals found in them so far
+        self.scanning = set()
+        self.blocks = 0
+        self.scanned_withdrawals = {}
+
+        # account lookups, fetched ones wait for the scan to be recorded
+        self.futures = {}
+        self.remaining = set()
+        self.fetched = []
+        self.completed = 0
+
+        # reports are held until every earlier run is done, see _write_reports
+        self.reports = []
+        self.writing = False
+
+        self.retries = []
+
+    def done(self):
+        return not (self.remaining or self.scanning or self.fetched)
+
+    def cancel(self):
+        for future in self.remaining | self.scanning: future.cancel()
@@ -1,7 +1,12 @@
 from datetime import timedelta, datetime
 from re import sub
-from os.path import join
-from csv import DictWriter, QUOTE_MINIMAL
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from gzip import open as gzip_open
+from itertools import chain, groupby
+from json import dumps
+from operator import attrgetter
+from os.path import join, exists, getsize
+from csv import DictWriter, QUOTE_MINIMAL, writer as csv_writer
 
 
 def report_days(start_time, end_time):
@@ -32,7 +37,7 @@ def accounts_to_run(whitelist, blacklist):
     return f
 
 
-def account_discoverer(api, force=False, whitelist=None):
+def account_discoverer(api, force=False, whitelist=None, concurrency=1):
     def wrapped(height, existing_run):
         # ensure accounts on whitelist are in the database
         for address in (whitelist or []):
@@ -43,12 +48,22 @@ def account_discoverer(api, force=False, whitelist=None):
         # there's no need to detect/discover all accounts on the chain
         if force or (existing_run is None and whitelist is None):
             print(f"\tRetrieve all validators & delegations at height {height}...", flush=True)
-            for delegator_address in api.discover_delegators_at_height(height):
+            for delegator_address in api.discover_delegators_at_height(height, concurrency=concurrency):
                 yield delegator_address, height
 
     return wrapped
 
 
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch: yield batch
+
+
 def setup_runs(db, api, runs_start_at, account_discoverer, debug=False):
     print("Determining runs & detecting accounts...", flush=True)
 
@@ -62,8 +77,7 @@ def setup_runs(db, api, runs_start_at, account_discoverer, debug=False):
         latest_height = latest_block.height
         latest_time = latest_block.timestamp
     elif runs_start_at == 'latest-run':
-        latest_block = api.get_block(latest_run.height)
-        latest_height = latest_block.height
+        latest_height = latest_run.height
         latest_time = latest_run.target_timestamp
 
     blocks_rate = blocks_per_day(
@@ -88,13 +102,13 @@ def setup_runs(db, api, runs_start_at, account_discoverer, debug=False):
             # find appropriate block for this day
             guess_height = latest_height + blocks_rate
 
-            report_block = api.get_block_closest_to(target_time, guess_height)
+            report_block = api.get_block_closest_to(target_time, guess_height, head=head)
             report_height = report_block.height
             report_time = report_block.timestamp
             print(report_height, flush=True)
 
-        for address, height in account_discoverer(report_height, existing_run):
-            db.add_account(address, height)
+        for accounts in batched(account_discoverer(report_height, existing_run), 1000):
+            db.add_accounts(accounts)
 
         db.create_run(report_height, target_time)
 
@@ -109,33 +123,148 @@ def setup_runs(db, api, runs_start_at, account_discoverer, debug=False):
     return latest_run
 
 
-def export_csvs(db, csv_path, denom, accounts):
+report_fields = (
+    'timestamp',
+    'height',
+    'pending_rewards',
+    'pending_commission',
+    'withdrawals',
+    'income',
+)
+report_header = dict([(field, sub('_', ' ', field).title()) for field in report_fields])
+
+
+def safe_denom(denom):
+    # ibc/27394F... -> ibc-27394F..., for denoms in file names
+    return sub(r'[^\w.-]', '-', denom)
+
+
+def report_writer(f, fields=report_fields):
+    return DictWriter(
+        f,
+        fieldnames=fields,
+        extrasaction='ignore',
+        quoting=QUOTE_MINIMAL
+    )
+
+
+def export_csvs(db, csv_path, denom, accounts, incremental=False, concurrency=1):
     if csv_path is None: return
 
     print("\nGenerating CSV reports...", flush=True)
 
-    fields = (
-        'timestamp',
-        'height',
-        'pending_rewards',
-        'pending_commission',
-        'withdrawals',
-        'income',
-    )
-    header = dict([(field, sub('_', ' ', field).title()) for field in fields])
+    if not incremental:
+        return export_csvs_in_bulk(db, csv_path, denom, accounts, concurrency=concurrency)
 
     count = len(accounts)
     for index, account in enumerate(accounts):
         print(f"\r{account.address} ({str(index+1).rjust(len(str(count)))}/{count})", end='', flush=True)
-        lines = db.get_full_report(account.address)
-
-        report_path = join(csv_path, f"{account.address}-{denom}.csv")
-        with open(report_path, 'w', newline='') as csvfile:
-            writer = DictWriter(
-                csvfile,
-                fieldnames=fields,
-                extrasaction='ignore',
-                quoting=QUOTE_MINIMAL
-            )
-            writer.writerow(header)
-            writer.writerows(map(lambda line: line._asdict(), lines))
+        report_path = join(csv_path, f"{account.address}-{safe_denom(denom)}.csv")
+
+        # only append lines after what was exported last time, unless
+        # the file was touched or reports were added before those lines
+        export = db.get_export(report_path, denom)
+        append = export is not None and \
+                 exists(report_path) and getsize(report_path) == export.size and \
+                 db.count_reports(account.address, export.height, denom) == export.rows
+
+        lines = db.get_reports(account.address, after_height=export.height if append else None, denom=denom)
+        first_line = next(lines, None)
+        if append and first_line is None: continue
+
+        rows = export.rows if append else 0
+        height = export.height if append else 0
+        with open(report_path, 'a' if append else 'w', newline='') as csvfile:
+            writer = report_writer(csvfile)
+            if not append: writer.writerow(report_header)
+
+            for line in chain([first_line] if first_line else [], lines):
+                writer.writerow(line._asdict())
+                rows += 1
+                height = line.height
+
+        db.save_export(report_path, height, rows, getsize(report_path), denom)
+
+    db.commit()
+
+
+def export_csvs_in_bulk(db, csv_path, denom, accounts, concurrency=1):
+    # one scan over every account's reports, ordered by address,
+    # each account's lines are handed to a writer thread
+    def write(address, rows):
+        with open(join(csv_path, f"{address}-{safe_denom(denom)}.csv"), 'w', newline='') as csvfile:
+            writer = csv_writer(csvfile, quoting=QUOTE_MINIMAL)
+            writer.writerow(map(lambda field: report_header[field], report_fields))
+            writer.writerows(rows)
+
+    # plain rows in report_fields' order, cheaper to write than dicts
+    to_row = attrgetter(*report_fields)
+
+    addresses = set(map(lambda account: account.address, accounts))
+    count = len(addresses)
+    written = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+        for address, lines in groupby(db.get_reports(denom=denom), key=lambda line: line.address):
+            if address not in addresses: continue
+            addresses.remove(address)
+
+            # don't read further ahead than the writers can keep up with
+            if len(pending) >= concurrency * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done: future.result()
+
+            pending.add(executor.submit(write, address, list(map(to_row, lines))))
+            written += 1
+            print(f"\r{address} ({str(written).rjust(len(str(count)))}/{count})", end='', flush=True)
+
+        # accounts without any reports still get a file
+        for address in addresses:
+            pending.add(executor.submit(write, address, []))
+
+        for future in pending: future.result()
+
+
+def export_consolidated(db, path, denom, accounts, format='csv', compress=False):
+    # every account's lines in a single file, with an address column
+    print(f"\nGenerating consolidated {format} report...", flush=True)
+
+    addresses = set(map(lambda account: account.address, accounts))
+    report_path = join(path, f"{safe_denom(denom)}.{format}" + ('.gz' if compress else ''))
+    opener = (lambda path: gzip_open(path, 'wt', compresslevel=6, newline='')) if compress else \
+             (lambda path: open(path, 'w', newline=''))
+
+    with opener(report_path) as f:
+        if format == 'csv':
+            to_row = attrgetter('address', *report_fields)
+            writer = csv_writer(f, quoting=QUOTE_MINIMAL)
+            writer.writerow(['Address'] + list(map(lambda field: report_header[field], report_fields)))
+
+        for line in db.get_reports(denom=denom):
+            if line.address not in addresses: continue
+
+            if format == 'csv':
+                writer.writerow(to_row(line))
+            else:
+                f.write(dumps(line._asdict(), default=str) + '\n')
+
+    print(report_path, flush=True)
+
+
+def export_rollups(db, path, denom, accounts, period):
+    # one line per account & month/year, read from the db's rollups
+    print(f"\nGenerating {period}ly income report...", flush=True)
+
+    addresses = set(map(lambda account: account.address, accounts))
+    report_path = join(path, f"{safe_denom(denom)}-{period}ly.csv")
+
+    with open(report_path, 'w', newline='') as f:
+        writer = csv_writer(f, quoting=QUOTE_MINIMAL)
+        writer.writerow(('Address', period.title(), 'Income', 'Withdrawals'))
+
+        for line in db.get_rollups(period, denom=denom):
+            if line.address not in addresses: continue
+            writer.writerow((line.address, line.start, line.income, line.withdrawals))
+
+    print(report_path, flush=True)
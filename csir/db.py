@@ -1,16 +1,54 @@
 from sqlite3 import connect, PARSE_DECLTYPES, PARSE_COLNAMES, Row
 from collections import namedtuple
+from datetime import datetime
+
+
+ReportLine = namedtuple('ReportLine', (
+    'timestamp',
+    'height',
+    'address',
+    'denom',
+    'pending_rewards',
+    'pending_commission',
+    'withdrawals',
+    'income',
+))
+
+RollupLine = namedtuple('RollupLine', (
+    'address',
+    'denom',
+    'period',
+    'start',
+    'income',
+    'withdrawals',
+))
 
 
 class Db():
-    def __init__(self, path, denom, scale, debug=False):
+    # reports buffered before they're written & committed together
+    report_batch_size = 1000
+
+    def __init__(self, path, denom, scale, debug=False, wal=False):
         self.debug = debug
         self.__conn = connect(path, detect_types=PARSE_DECLTYPES|PARSE_COLNAMES)
         self.__conn.row_factory = Row
+
+        # lets exports & other readers query while a run is writing,
+        # a crash may lose the last commits but never corrupts the db
+        if wal:
+            self.__conn.execute('PRAGMA journal_mode = WAL;')
+            self.__conn.execute('PRAGMA synchronous = NORMAL;')
+            self.__conn.execute('PRAGMA temp_store = MEMORY;')
+            self.__conn.execute('PRAGMA cache_size = -65536;')
+
         self.__migrate_schema()
 
-        self.denom = denom
+        # one or more denoms, reports are recorded for each of them & the
+        # first one's runs drive the others (runs are kept for every denom)
+        self.denoms = list(denom) if isinstance(denom, (list, tuple)) else [denom]
+        self.denom = self.denoms[0]
         self.scale = scale
+        self.__pending_reports = []
 
     def commit(self):
         self.__conn.commit()
@@ -32,80 +70,331 @@ class Db():
             VALUES (?, ?);
         ''', (address, height))
 
-    def get_latest_report_height_for(self, address):
+    def add_accounts(self, accounts):
+        self.__conn.executemany('''
+            INSERT OR IGNORE INTO accounts (address, first_seen_height)
+            VALUES (?, ?);
+        ''', accounts)
+
+    def get_latest_report_height_for(self, address, denom=None):
         c = self.__conn.cursor()
         r = c.execute('''
-            SELECT * FROM reports
-            WHERE address = ? AND denom = ?
-            ORDER BY height DESC
-            LIMIT 1;
-        ''', (address, self.denom))
-        row = r.fetchone()
-        if row is None: return 0
-        return row['height']
-
-    def insert_report(self, address, run, values):
-        self.__conn.execute('''
-            INSERT INTO reports(timestamp, height, address, denom,
-                                pending_rewards, pending_commission, withdrawals)
-            VALUES (?, ?, ?, ?, ?, ?, ?);
-        ''', (
+            SELECT MAX(height) AS height FROM reports
+            WHERE address = ? AND denom = ?;
+        ''', (address, denom or self.denom))
+        return r.fetchone()['height'] or 0
+
+    def get_addresses_needing_report_at(self, height, denom=None):
+        # accounts seen by this height without a report at or after it,
+        # one seek per account on reports_addr_denom_height
+        c = self.__conn.cursor()
+        r = c.execute('''
+            SELECT address FROM accounts
+            WHERE first_seen_height <= ?
+              AND NOT EXISTS (
+                SELECT 1 FROM reports
+                WHERE reports.address = accounts.address
+                  AND reports.denom = ? AND reports.height >= ?
+              );
+        ''', (height, denom or self.denom, height))
+        return set(row['address'] for row in r)
+
+    def insert_report(self, address, run, values, denom=None):
+        self.__pending_reports.append((
             run.target_timestamp,
             run.height,
             address,
-            self.denom,
+            denom or self.denom,
             values['pending_rewards'],
             values['pending_commission'],
             values['withdrawals'],
         ))
+        if len(self.__pending_reports) >= self.__class__.report_batch_size:
+            self.flush_reports()
+
+    def flush_reports(self):
+        # committed in chunks, accounts that already have a
+        # report are skipped if a run has to be picked up again
+        if self.__pending_reports:
+            last_rowid = self.__conn.execute('''
+                SELECT COALESCE(MAX(rowid), 0) FROM reports;
+            ''').fetchone()[0]
+
+            self.__conn.executemany('''
+                INSERT INTO reports(timestamp, height, address, denom,
+                                    pending_rewards, pending_commission, withdrawals)
+                VALUES (?, ?, ?, ?, ?, ?, ?);
+            ''', self.__pending_reports)
+            self.__pending_reports = []
+
+            # in the same transaction, so every report is rolled up exactly once
+            self.__update_rollups(last_rowid)
+        self.commit()
+
+    def __update_rollups(self, last_rowid):
+        # each new report adds its income to its month & year, and if it
+        # lands before an already rolled up report, that report's income
+        # now counts from the new one instead of the one before it
+        self.__conn.execute('''
+            WITH new AS (
+                SELECT r.address, r.denom, r.timestamp, r.withdrawals,
+                       r.pending_rewards + r.pending_commission AS pending,
+                       COALESCE((
+                           SELECT p.pending_rewards + p.pending_commission FROM reports p
+                           WHERE p.address = r.address AND p.denom = r.denom AND p.height < r.height
+                           ORDER BY p.height DESC LIMIT 1
+                       ), 0) AS previous_pending,
+                       COALESCE((
+                           SELECT p.pending_rewards + p.pending_commission FROM reports p
+                           WHERE p.address = r.address AND p.denom = r.denom AND p.height < r.height
+                             AND p.rowid <= :last_rowid
+                           ORDER BY p.height DESC LIMIT 1
+                       ), 0) AS rolled_up_previous_pending,
+                       (
+                           SELECT n.rowid FROM reports n
+                           WHERE n.address = r.address AND n.denom = r.denom AND n.height > r.height
+                           ORDER BY n.height ASC LIMIT 1
+                       ) AS next_rowid
+                FROM reports r
+                WHERE r.rowid > :last_rowid
+            ),
+            changes AS (
+                SELECT address, denom, timestamp, withdrawals,
+                       withdrawals + pending - previous_pending AS income
+                FROM new
+                UNION ALL
+                SELECT n.address, n.denom, n.timestamp, 0,
+                       new.rolled_up_previous_pending - new.pending AS income
+                FROM new
+                JOIN reports n ON n.rowid = new.next_rowid
+                WHERE n.rowid <= :last_rowid
+            )
+            INSERT INTO rollups(address, denom, period, start, income, withdrawals)
+            SELECT * FROM (
+                SELECT address, denom, 'month', strftime('%Y-%m', timestamp), SUM(income), SUM(withdrawals)
+                FROM changes
+                GROUP BY address, denom, strftime('%Y-%m', timestamp)
+                UNION ALL
+                SELECT address, denom, 'year', strftime('%Y', timestamp), SUM(income), SUM(withdrawals)
+                FROM changes
+                GROUP BY address, denom, strftime('%Y', timestamp)
+            ) WHERE true
+            ON CONFLICT (address, denom, period, start) DO UPDATE
+            SET income = income + excluded.income,
+                withdrawals = withdrawals + excluded.withdrawals;
+        ''', {'last_rowid': last_rowid})
+
+    def get_rollups(self, period, address=None, denom=None):
+        # income & withdrawals per month ('2020-01') or year ('2020')
+        extra_address_filter = " AND address = ? " if address else ''
+        args = (denom or self.denom, period)
+        if address: args += (address,)
 
-    def get_full_report(self, address):
+        c = self.__conn.cursor()
+        c.row_factory = None
+        r = c.execute(f'''
+            SELECT address, denom, period, start, income, withdrawals
+            FROM rollups
+            WHERE denom = ? AND period = ? {extra_address_filter}
+            ORDER BY address ASC, start ASC;
+        ''', args)
+
+        factor = 10**-self.scale
+
+        for address, denom, period, start, income, withdrawals in r:
+            yield RollupLine(
+                address,
+                denom,
+                period,
+                start,
+                round(income * factor, 3),
+                round(withdrawals * factor, 3),
+            )
+
+    def get_full_report(self, address, denom=None):
+        return list(self.get_reports(address, denom=denom))
+
+    def get_reports(self, address=None, after_height=None, denom=None):
+        # streams report lines for one address, or every address (ordered
+        # by address), with income from the previous line's pending amounts:
+        #   total withdrawals +
+        #   today's pending rewards - yesterday's pending rewards -
+        #   today's pending commission - yesterday's pending commission
+        extra_address_filter = " AND address = ? " if address else ''
+        args = (denom or self.denom,)
+        if address: args += (address,)
+
+        # lines after a height still need the line before them for income
+        extra_height_filter = " WHERE height > ? " if after_height is not None else ''
+        if after_height is not None: args += (after_height,)
+
+        # plain tuples, there can be millions of these
+        c = self.__conn.cursor()
+        c.row_factory = None
+        r = c.execute(f'''
+            SELECT * FROM (
+                SELECT timestamp, height, address, denom,
+                       pending_rewards, pending_commission, withdrawals,
+                       withdrawals +
+                       pending_commission - LAG(pending_commission, 1, 0) OVER previous +
+                       pending_rewards - LAG(pending_rewards, 1, 0) OVER previous AS income
+                FROM reports
+                WHERE denom = ? {extra_address_filter}
+                WINDOW previous AS (PARTITION BY address ORDER BY timestamp ASC)
+            ) {extra_height_filter}
+            ORDER BY address ASC, timestamp ASC;
+        ''', args)
+
+        factor = 10**-self.scale
+
+        for timestamp, height, address, denom, rewards, commission, withdrawals, income in r:
+            yield ReportLine(
+                timestamp,
+                height,
+                address,
+                denom,
+                round(rewards * factor, 3),
+                round(commission * factor, 3),
+                round(withdrawals * factor, 3),
+                round(income * factor, 3),
+            )
+
+    def count_reports(self, address, up_to_height, denom=None):
         c = self.__conn.cursor()
         r = c.execute('''
-            SELECT * FROM reports
-            WHERE address = ? AND denom = ?
-            ORDER BY timestamp ASC;
-        ''', (address, self.denom))
-        rows = r.fetchall()
-
-        def process(i, row):
-            row = dict(row)
-            last_state = rows and (i-1 >= 0) and rows[i-1] or {
-                'pending_commission': 0,
-                'pending_rewards': 0
-            }
-
-            # to calculate income:
-            #   total withdrawals +
-            #   today's pending rewards - yesterday's pending rewards -
-            #   today's pending commission - yesterday's pending commission
-            income = row['withdrawals'] + \
-                     row['pending_commission'] - last_state['pending_commission'] + \
-                     row['pending_rewards'] - last_state['pending_rewards']
-
-            scale = lambda amount: round(amount * 10**-self.scale, 3)
-            row['income'] = scale(income)
-            row['withdrawals'] = scale(row['withdrawals'])
-            row['pending_commission'] = scale(row['pending_commission'])
-            row['pending_rewards'] = scale(row['pending_rewards'])
-
-            return namedtuple('ReportLine', ' '.join(row.keys()))(**row)
-
-        return [process(i, row) for (i, row) in enumerate(rows)]
+            SELECT COUNT(*) AS count FROM reports
+            WHERE address = ? AND denom = ? AND height <= ?;
+        ''', (address, denom or self.denom, up_to_height))
+        return r.fetchone()['count']
 
-    def create_run(self, height, target_time):
+    def get_export(self, path, denom=None):
         c = self.__conn.cursor()
-        c.execute('''
-            INSERT OR IGNORE INTO runs(target_timestamp, height, denom)
-            VALUES (?, ?, ?)
-        ''', (target_time, height, self.denom))
-        run_id = c.lastrowid
+        r = c.execute('''
+            SELECT * FROM exports
+            WHERE path = ? AND denom = ?;
+        ''', (path, denom or self.denom))
+        row = r.fetchone()
+        if row is None: return None
+        return namedtuple('Export', ' '.join(row.keys()))(**row)
 
-        c.execute('''
-            UPDATE runs
-            SET status = 'RUNNING'
-            WHERE rowid = ?;
-        ''', (run_id,))
+    def save_export(self, path, height, rows, size, denom=None):
+        self.__conn.execute('''
+            INSERT OR REPLACE INTO exports(path, denom, height, rows, size)
+            VALUES (?, ?, ?, ?, ?);
+        ''', (path, denom or self.denom, height, rows, size))
+
+    def get_tx_history(self, address):
+        c = self.__conn.cursor()
+        r = c.execute('''
+            SELECT * FROM tx_histories
+            WHERE address = ?;
+        ''', (address,))
+        row = r.fetchone()
+        if row is None: return None
+        return namedtuple('TxHistory', ' '.join(row.keys()))(**row)
+
+    def save_tx_history(self, address, page, page_offset, synced_height):
+        self.__conn.execute('''
+            INSERT OR REPLACE INTO tx_histories(address, page, page_offset, synced_height)
+            VALUES (?, ?, ?, ?);
+        ''', (address, page, page_offset, synced_height))
+
+    def add_transactions(self, txs, network):
+        for tx in txs:
+            c = self.__conn.cursor()
+            c.execute('''
+                INSERT OR IGNORE INTO transactions(txhash, height, msg_types,
+                                                   succeeded, reward_disbursement)
+                VALUES (?, ?, ?, ?, ?);
+            ''', (
+                tx.txhash,
+                tx.height,
+                ','.join(sorted(tx.msg_types)),
+                tx.succeeded,
+                tx.is_reward_disbursement_type(network),
+            ))
+
+            # already stored via another one of our accounts
+            if c.rowcount == 0: continue
+
+            c.executemany('''
+                INSERT OR IGNORE INTO transfers(txhash, height, recipient, denom, amount)
+                VALUES (?, ?, ?, ?, ?);
+            ''', [
+                (tx.txhash, tx.height, recipient, denom, amount)
+                for recipient, amounts in tx.transfers().items()
+                for denom, amount in amounts.items()
+            ])
+
+    def get_withdrawals_by_denom(self, address, start_height, end_height):
+        c = self.__conn.cursor()
+        r = c.execute(f'''
+            SELECT transfers.denom, SUM(transfers.amount) AS withdrawals
+            FROM transfers
+            JOIN transactions ON transactions.txhash = transfers.txhash
+            WHERE transfers.recipient = ? AND transfers.denom IN ({', '.join('?' * len(self.denoms))})
+              AND transfers.height BETWEEN ? AND ?
+              AND transactions.succeeded AND transactions.reward_disbursement
+            GROUP BY transfers.denom;
+        ''', (address, *self.denoms, start_height, end_height))
+        withdrawals = dict((row['denom'], row['withdrawals']) for row in r)
+        return dict((denom, withdrawals.get(denom, 0)) for denom in self.denoms)
+
+    def get_block(self, height):
+        c = self.__conn.cursor()
+        r = c.execute('''
+            SELECT * FROM blocks
+            WHERE height = ?;
+        ''', (height,))
+        row = r.fetchone()
+        if row is None: return None
+        return namedtuple('Block', ' '.join(row.keys()))(**row)
+
+    def get_blocks_around(self, timestamp):
+        c = self.__conn.cursor()
+        r = c.execute('''
+            SELECT * FROM blocks
+            WHERE timestamp < ?
+            ORDER BY timestamp DESC
+            LIMIT 1;
+        ''', (timestamp,))
+        before = r.fetchone()
+
+        r = c.execute('''
+            SELECT * FROM blocks
+            WHERE timestamp >= ?
+            ORDER BY timestamp ASC
+            LIMIT 1;
+        ''', (timestamp,))
+        after = r.fetchone()
+
+        return tuple(
+            row and namedtuple('Block', ' '.join(row.keys()))(**row)
+            for row in (before, after)
+        )
+
+    def add_block(self, height, timestamp):
+        self.__conn.execute('''
+            INSERT OR IGNORE INTO blocks(height, timestamp)
+            VALUES (?, ?);
+        ''', (height, timestamp))
+
+    def create_run(self, height, target_time):
+        c = self.__conn.cursor()
+        run_id = None
+        for denom in self.denoms:
+            c.execute('''
+                INSERT OR IGNORE INTO runs(target_timestamp, height, denom)
+                VALUES (?, ?, ?)
+            ''', (target_time, height, denom))
+            if run_id is None: run_id = c.lastrowid
+
+            if c.rowcount > 0:
+                c.execute('''
+                    UPDATE runs
+                    SET status = 'RUNNING'
+                    WHERE rowid = ?;
+                ''', (c.lastrowid,))
         self.commit()
 
         return run_id
@@ -165,19 +454,21 @@ class Db():
         return namedtuple('Run', ' '.join(row.keys()))(**row)
 
     def run_ok(self, run):
-        self.__conn.execute('''
+        self.flush_reports()
+        self.__conn.execute(f'''
             UPDATE runs
             SET status = 'OK'
-            WHERE rowid = ?;
-        ''', (run.rowid,))
+            WHERE height = ? AND denom IN ({', '.join('?' * len(self.denoms))});
+        ''', (run.height, *self.denoms))
         self.commit()
 
     def run_error(self, run):
-        self.__conn.execute('''
+        self.flush_reports()
+        self.__conn.execute(f'''
             UPDATE runs
             SET status = 'ERROR'
-            WHERE rowid = ?;
-        ''', (run.rowid,))
+            WHERE height = ? AND denom IN ({', '.join('?' * len(self.denoms))});
+        ''', (run.height, *self.denoms))
         self.commit()
 
     def __migrate_schema(self):
@@ -198,7 +489,7 @@ class Db():
         version = c.fetchone()['current_version'] or 0
 
         if self.debug:
-            print("\tSCHEMA VERSION: %s, LATEST %s" % (version, 1))
+            print("\tSCHEMA VERSION: %s, LATEST %s" % (version, 6))
 
         # initial version
         if version < 1:
@@ -247,4 +538,153 @@ class Db():
                 CREATE UNIQUE INDEX IF NOT EXISTS accounts_addr
                 ON accounts (address);
             ''')
+            self.__conn.execute('''
+                INSERT INTO schema_version(version, timestamp)
+                VALUES (?, ?);
+            ''', (1, datetime.now()))
+            self.commit()
+
+        # local transaction store
+        if version < 2:
+            if self.debug:
+                print("\t\tMIGRATING TO SCHEMA VERSION 2...")
+
+            self.__conn.execute('''
+                CREATE TABLE IF NOT EXISTS transactions (
+                    txhash TEXT PRIMARY KEY,
+                    height INTEGER,
+                    msg_types TEXT,
+                    succeeded INTEGER,
+                    reward_disbursement INTEGER
+                );
+            ''')
+            self.__conn.execute('''
+                CREATE TABLE IF NOT EXISTS transfers (
+                    txhash TEXT,
+                    height INTEGER,
+                    recipient TEXT,
+                    denom TEXT,
+                    amount INTEGER
+                );
+            ''')
+            self.__conn.execute('''
+                CREATE TABLE IF NOT EXISTS tx_histories (
+                    address TEXT PRIMARY KEY,
+                    page INTEGER,
+                    page_offset INTEGER,
+                    synced_height INTEGER
+                );
+            ''')
+
+            self.__conn.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS transfers_txhash_recipient_denom
+                ON transfers (txhash, recipient, denom);
+            ''')
+            self.__conn.execute('''
+                CREATE INDEX IF NOT EXISTS transfers_recipient_denom_height
+                ON transfers (recipient, denom, height);
+            ''')
+            self.__conn.execute('''
+                INSERT INTO schema_version(version, timestamp)
+                VALUES (?, ?);
+            ''', (2, datetime.now()))
+            self.commit()
+
+        # block height -> time index
+        if version < 3:
+            if self.debug:
+                print("\t\tMIGRATING TO SCHEMA VERSION 3...")
+
+            self.__conn.execute('''
+                CREATE TABLE IF NOT EXISTS blocks (
+                    height INTEGER PRIMARY KEY,
+                    timestamp TIMESTAMP
+                );
+            ''')
+            self.__conn.execute('''
+                CREATE INDEX IF NOT EXISTS blocks_timestamp
+                ON blocks (timestamp);
+            ''')
+            self.__conn.execute('''
+                INSERT INTO schema_version(version, timestamp)
+                VALUES (?, ?);
+            ''', (3, datetime.now()))
+            self.commit()
+
+        # covering index for latest report heights
+        if version < 4:
+            if self.debug:
+                print("\t\tMIGRATING TO SCHEMA VERSION 4...")
+
+            self.__conn.execute('''
+                CREATE INDEX IF NOT EXISTS reports_addr_denom_height
+                ON reports (address, denom, height);
+            ''')
+            self.__conn.execute('''
+                DROP INDEX IF EXISTS reports_addr_denom;
+            ''')
+            self.__conn.execute('''
+                INSERT INTO schema_version(version, timestamp)
+                VALUES (?, ?);
+            ''', (4, datetime.now()))
+            self.commit()
+
+        # what's been written to each exported file so far
+        if version < 5:
+            if self.debug:
+                print("\t\tMIGRATING TO SCHEMA VERSION 5...")
+
+            self.__conn.execute('''
+                CREATE TABLE IF NOT EXISTS exports (
+                    path TEXT,
+                    denom TEXT,
+                    height INTEGER,
+                    rows INTEGER,
+                    size INTEGER,
+                    PRIMARY KEY (path, denom)
+                );
+            ''')
+            self.__conn.execute('''
+                INSERT INTO schema_version(version, timestamp)
+                VALUES (?, ?);
+            ''', (5, datetime.now()))
+            self.commit()
+
+        # monthly & yearly income, kept up to date by flush_reports
+        if version < 6:
+            if self.debug:
+                print("\t\tMIGRATING TO SCHEMA VERSION 6...")
+
+            self.__conn.execute('''
+                CREATE TABLE IF NOT EXISTS rollups (
+                    address TEXT,
+                    denom TEXT,
+                    period TEXT,
+                    start TEXT,
+                    income INTEGER,
+                    withdrawals INTEGER,
+                    PRIMARY KEY (address, denom, period, start)
+                );
+            ''')
+
+            # roll up the reports we already have
+            for period, format in (('month', '%Y-%m'), ('year', '%Y')):
+                self.__conn.execute('''
+                    INSERT INTO rollups(address, denom, period, start, income, withdrawals)
+                    SELECT address, denom, ?, strftime(?, timestamp), SUM(income), SUM(withdrawals)
+                    FROM (
+                        SELECT address, denom, timestamp, withdrawals,
+                               withdrawals +
+                               pending_commission - LAG(pending_commission, 1, 0) OVER previous +
+                               pending_rewards - LAG(pending_rewards, 1, 0) OVER previous AS income
+                        FROM reports
+                        WINDOW previous AS (PARTITION BY address, denom ORDER BY height ASC)
+                    )
+                    GROUP BY address, denom, strftime(?, timestamp);
+                ''', (period, format, format))
+
+            self.__conn.execute('''
+                INSERT INTO schema_version(version, timestamp)
+                VALUES (?, ?);
+            ''', (6, datetime.now()))
             self.commit()
@@ -0,0 +1,104 @@
+from json import loads
+
+# optional, without it responses are decoded whole & pruned afterwards
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# fields are dotted paths like ijson's prefixes, eg. 'txs.item.height'
+# ('item' being any element of an array), a field keeps its whole subtree
+def wanted(prefix, fields):
+    if prefix == '': return True
+    return any(
+        prefix == field or prefix.startswith(field + '.') or field.startswith(prefix + '.')
+        for field in fields
+    )
+
+
+def decode_fields(response, fields):
+    # builds only the wanted parts of the body while it's being read,
+    # so skipped fields never become python objects
+    if ijson is None:
+        return prune(loads(response.content), fields)
+
+    cache = {}
+    root = None
+    stack = []
+    key = None
+
+    def attach(value):
+        nonlocal root
+        if not stack:
+            root = value
+        elif isinstance(stack[-1], list):
+            stack[-1].append(value)
+        else:
+            stack[-1][key] = value
+
+    def build(events):
+        nonlocal key
+        for prefix, event, value in events:
+            keep = cache.get(prefix)
+            if keep is None:
+                keep = cache[prefix] = wanted(prefix, fields)
+            if not keep: continue
+
+            if event == 'map_key':
+                key = value
+            elif event in ('start_map', 'start_array'):
+                container = {} if event == 'start_map' else []
+                attach(container)
+                stack.append(container)
+            elif event in ('end_map', 'end_array'):
+                stack.pop()
+            else:
+                attach(value)
+        del events[:]
+
+    # fed chunk by chunk, so requests still handles
+    # content encodings & wraps connection errors
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events, use_float=True)
+    try:
+        for chunk in response.iter_content(64 * 1024):
+            parser.send(chunk)
+            build(events)
+        parser.close()
+        build(events)
+    except ijson.JSONError as error:
+        raise ValueError(f"Invalid json from {response.url}: {error}") from error
+
+    return root
+
+
+def prune(json, fields):
+    return __prune(json, field_tree(fields))
+
+
+def field_tree(fields):
+    # 'txs.item.height' -> {'txs': {'item': {'height': True}}}
+    tree = {}
+    for field in fields:
+        node = tree
+        *parents, leaf = field.split('.')
+        for part in parents:
+            node = node.setdefault(part, {})
+            if node is True: break
+        else:
+            node[leaf] = True
+    return tree
+
+
+def __prune(json, tree):
+    if tree is True: return json
+    if isinstance(json, dict):
+        return dict(
+            (key, __prune(value, tree[key]))
+            for key, value in json.items()
+            if key in tree
+        )
+    if isinstance(json, list) and 'item' in tree:
+        return [__prune(value, tree['item']) for value in json]
+    return json
@@ -1,5 +1,7 @@
+from base64 import b64decode
 from itertools import chain
-from re import search
+from re import compile
+from sys import intern
 
 
 class Transaction():
@@ -29,13 +31,33 @@ class Transaction():
         )),
     }
 
+    # txs from tendermint's rpc don't come with their decoded msgs,
+    # only the action of each msg from the tx's message events
+    msg_actions = frozenset((
+        'delegate',
+        'begin_redelegate',
+        'begin_unbonding',
+        'withdraw_delegator_reward',
+        'withdraw_validator_commission',
+    ))
+
+    coin_pattern = compile(r'(\d+)(.+)')
+
+    # txs are kept around by the thousand, so only what we read is kept,
+    # the transfer events until transfers() first indexes them
+    __slots__ = ('height', 'txhash', 'succeeded', 'msg_types', '__transfer_attributes', '__transfers')
+
     def __init__(self, data):
-        self._data = data
         self.height = int(data['height'])
         self.txhash = data['txhash']
-        self.events = data['events']
         self.succeeded = data['logs'][0]['success']
-        self.msg_types = set(map(lambda msg: msg['type'], data['tx']['value']['msg']))
+        self.msg_types = frozenset(map(lambda msg: intern(msg['type']), data['tx']['value']['msg']))
+
+        self.__transfer_attributes = [
+            ev['attributes'] for ev in data['events'] or []
+            if ev['type'] == 'transfer'
+        ]
+        self.__transfers = None
 
     def is_between(self, start_height, end_height):
         return self.height >= start_height and \
@@ -43,23 +65,57 @@ class Transaction():
 
     def is_reward_disbursement_type(self, network):
         network_types = self.__class__.msg_types_by_network.get(network)
-        return len(self.msg_types & network_types) > 0
+        return len(self.msg_types & (network_types | self.__class__.msg_actions)) > 0
 
     def disbursement(self, to_address, denom):
-        events = list(chain(*map(
-            lambda ev: ev['attributes'],
-            filter(lambda ev: ev['type'] == 'transfer', self.events)
-        )))
+        return self.transfers().get(to_address, {}).get(denom, 0)
 
-        total = 0
+    def transfers(self):
+        # recipient -> denom -> total amount, built once
+        if self.__transfers is not None: return self.__transfers
+
+        totals = {}
 
         latest_recipient = None
-        for event in events:
+        for event in chain(*self.__transfer_attributes):
             if event['key'] == 'recipient':
                 latest_recipient = event['value']
-            elif event['key'] == 'amount' and latest_recipient == to_address:
-                for value in event['value'].split(','):
-                    if value.endswith(denom):
-                        total += int(search(r'\d+', value).group())
+            elif event['key'] == 'amount' and latest_recipient is not None:
+                amounts = totals.setdefault(latest_recipient, {})
+                for value in (event['value'] or '').split(','):
+                    coin = self.__class__.coin_pattern.match(value.strip())
+                    if coin is None: continue
+                    amount, denom = int(coin.group(1)), intern(coin.group(2))
+                    amounts[denom] = amounts.get(denom, 0) + amount
+
+        self.__transfers = totals
+        self.__transfer_attributes = None
+        return totals
+
+    @classmethod
+    def from_rpc(cls, data):
+        decode = lambda value: value and b64decode(value).decode('utf-8')
+        events = list(map(
+            lambda ev: {
+                'type': ev['type'],
+                'attributes': list(map(
+                    lambda attr: {'key': decode(attr['key']), 'value': decode(attr.get('value'))},
+                    ev.get('attributes') or []
+                ))
+            },
+            data['tx_result'].get('events') or []
+        ))
+
+        actions = chain(*map(
+            lambda ev: [attr['value'] for attr in ev['attributes'] if attr['key'] == 'action'],
+            filter(lambda ev: ev['type'] == 'message', events)
+        ))
 
-        return total
+        # normalise into the shape of the LCD's txs
+        return cls({
+            'height': data['height'],
+            'txhash': data['hash'],
+            'events': events,
+            'logs': [{'success': int(data['tx_result'].get('code') or 0) == 0}],
+            'tx': {'value': {'msg': [{'type': action} for action in actions]}},
+        })
@@ -0,0 +1,30 @@
+from re import sub
+
+
+class Endpoint():
+    # consecutive failures before we stop sending requests its
+    # way, until the next health check says it's fine again
+    max_failures = 3
+
+    def __init__(self, url, throttle=None):
+        self.url = sub('//$', '/', url+'/')
+        self.throttle = throttle
+
+        self.healthy = True
+        self.height = None
+        self.failures = 0
+
+        # moving average, in seconds
+        self.latency = None
+
+    def succeeded(self, latency):
+        self.failures = 0
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= self.__class__.max_failures:
+            self.healthy = False
+
+    def __repr__(self):
+        return self.url
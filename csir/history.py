@@ -0,0 +1,47 @@
+class TransactionHistory():
+    page_size = 100
+
+    def __init__(self, api, db, address, network):
+        self.api = api
+        self.db = db
+        self.address = address
+        self.network = network
+
+        # where to pick up paging from the next time we sync, the
+        # last page we saw may have been partial and can grow later
+        # (asking for a page past the end is an error on the LCD)
+        saved = db.get_tx_history(address)
+        self.page = saved.page if saved else 1
+        self.page_offset = saved.page_offset if saved else 0
+        self.synced_height = saved.synced_height if saved else 0
+
+    def fetch(self, store_page):
+        # only talks to the api, so it's safe to call off the db's thread,
+        # each page's new txs go to store_page (eg. a queue to the db's
+        # thread) as they come in, with the paging position after them
+        pages = self.api.get_transaction_pages(
+            {'transfer.recipient': self.address},
+            page=self.page,
+            limit=self.__class__.page_size
+        )
+
+        last_page, last_page_offset = self.page, self.page_offset
+        for page, txs in pages:
+            new_txs = txs[last_page_offset:] if page == last_page else txs
+            last_page, last_page_offset = page, len(txs)
+            store_page(new_txs, last_page, last_page_offset)
+
+    def store(self, txs, page, page_offset):
+        self.db.add_transactions(txs, self.network)
+
+        # picked up from here next time, even if fetching stops part way
+        self.page, self.page_offset = page, page_offset
+        self.db.save_tx_history(self.address, self.page, self.page_offset, self.synced_height)
+
+    def synced(self, height):
+        # everything up to this height is now in the store
+        self.synced_height = max(self.synced_height, height)
+        self.db.save_tx_history(self.address, self.page, self.page_offset, self.synced_height)
+
+    def covers(self, height):
+        return self.synced_height >= height
@@ -0,0 +1,135 @@
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from json import loads
+from random import random
+from threading import Lock, local
+from time import sleep
+
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+
+from csir.decode import decode_fields
+
+
+class ErrorResponse(RuntimeError):
+    # the node answered, with an error, asking again won't change that
+    pass
+
+
+class TransientResponse(RuntimeError):
+    def __init__(self, url, status, retry_after=None):
+        super().__init__(f"HTTP {status} from {url}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_response(response, fields=None):
+    # overloaded or behind a proxy that gave up on it
+    if response.status_code in (429, 502, 503, 504):
+        raise TransientResponse(response.url, response.status_code, retry_after(response))
+
+    try:
+        # only decode what the caller reads, see decode_fields
+        if fields and response.status_code == 200:
+            return decode_fields(response, fields)
+        return loads(response.content)
+    except ValueError:
+        # the cosmos-sdk LCD answers query errors with a json 500, anything else is the node
+        if response.status_code >= 500:
+            raise TransientResponse(response.url, response.status_code, retry_after(response))
+        raise
+
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None: return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryBudgetExhausted(RuntimeError):
+    pass
+
+
+class RunRetries():
+    def __init__(self, budget=None):
+        # retries left for the run, None for no limit
+        self.remaining = budget
+
+        # retries by endpoint, so slow or flaky nodes stand out
+        self.retries = Counter()
+
+
+class RetryPolicy():
+    def __init__(self, base_delay=0.1, max_delay=10.0, budget=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # retries allowed per run (see start_run), None for no limit
+        self.budget = budget
+
+        self.__run = RunRetries(budget)
+        self.__local = local()
+        self.__lock = Lock()
+
+    @property
+    def retries(self):
+        return self.__current().retries
+
+    def start_run(self):
+        # a fresh budget & counts, used by any thread not in another run (see for_run)
+        self.__run = RunRetries(self.budget)
+        return self.__run
+
+    @contextmanager
+    def for_run(self, run):
+        # retries on this thread count against run, eg. with several runs in flight
+        previous = getattr(self.__local, 'run', None)
+        self.__local.run = run
+        try:
+            yield run
+        finally:
+            self.__local.run = previous
+
+    def __current(self):
+        return getattr(self.__local, 'run', None) or self.__run
+
+    def is_retryable(self, error):
+        if isinstance(error, TransientResponse): return True
+        if isinstance(error, (ConnectionError, Timeout, ChunkedEncodingError)): return True
+        return False
+
+    def delay(self, attempt, error):
+        if getattr(error, 'retry_after', None) is not None:
+            return min(self.max_delay, error.retry_after)
+
+        # exponential backoff with full jitter
+        return random() * min(self.max_delay, self.base_delay * 2**(attempt-1))
+
+    def run(self, func, tries, key=None):
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as error:
+                attempt += 1
+                if attempt >= tries or not self.is_retryable(error): raise
+
+                run = self.__current()
+                with self.__lock:
+                    if run.remaining is not None:
+                        if run.remaining <= 0:
+                            raise RetryBudgetExhausted(f"Out of retries for this run, last error: {error}") from error
+                        run.remaining -= 1
+                    run.retries[key() if key else None] += 1
+
+                sleep(self.delay(attempt, error))
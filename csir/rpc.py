@@ -0,0 +1,79 @@
+from math import ceil
+from re import sub
+from urllib.parse import urljoin
+from datetime import datetime
+
+from csir.domain import Transaction
+from csir.retry import RetryPolicy, ErrorResponse, parse_response
+from csir.utils import pooled_session
+
+
+class Rpc():
+    per_page = 100
+
+    def __init__(self, rpc_base_url, retry_policy=None, pool_size=10, budget=None, debug=False):
+        self.debug = debug
+        self.budget = budget
+        self.rpc_base_url = sub('//$', '/', rpc_base_url+'/')
+        self.session = pooled_session(pool_size)
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def _get(self, path, params=None, retries=5):
+        def f():
+            if self.debug:
+                print(f"RPC: {urljoin(self.rpc_base_url, path)} {params}", end='', flush=True)
+                pass
+
+            start_time = datetime.now()
+            url = urljoin(self.rpc_base_url, path)
+            if self.budget: self.budget.acquire()
+            try:
+                response = self.session.get(url, params=params, timeout=(3.1, 15))
+                json = parse_response(response)
+            finally:
+                if self.budget: self.budget.release()
+
+            if 'error' in json:
+                raise ErrorResponse(f"ERROR making request: {url} with params {params} -> {json}")
+
+            if self.debug:
+                print(f" (took {datetime.now() - start_time})", flush=True)
+                pass
+
+            return json['result']
+
+        return self.retry_policy.run(f, retries, key=lambda: self.rpc_base_url)
+
+    def get_transactions(self, query, min_height=None, max_height=None):
+        # unlike the LCD's txs endpoint, tx_search can bound by height
+        conditions = [f"{key}='{value}'" for key, value in query.items()]
+        if min_height is not None: conditions.append(f"tx.height>={min_height}")
+        if max_height is not None: conditions.append(f"tx.height<={max_height}")
+
+        txs = []
+        page = 1
+
+        while True:
+            txsr = self._get('tx_search', {
+                'query': '"' + ' AND '.join(conditions) + '"',
+                'page': page,
+                'per_page': self.__class__.per_page,
+            })
+            txs.extend(txsr['txs'])
+
+            page_total = ceil(int(txsr['total_count']) / self.__class__.per_page)
+            if page >= page_total: break
+            page += 1
+
+        return list(map(lambda tx: Transaction.from_rpc(tx), txs))
+
+    def get_block_transactions(self, height):
+        r = self._get('block_results', {'height': height})
+
+        # tendermint 0.33+ vs. 0.32
+        results = r['txs_results'] if 'txs_results' in r else (r.get('results') or {}).get('deliver_tx')
+
+        return list(map(
+            lambda result: Transaction.from_rpc({'hash': None, 'height': r['height'], 'tx_result': result}),
+            results or []
+        ))
@@ -0,0 +1,74 @@
+from threading import Condition
+from time import monotonic, sleep
+
+
+class Throttle():
+    def __init__(self, max_concurrency=1, max_rate=None, min_concurrency=1, latency_tolerance=2.0):
+        self.max_concurrency = max(max_concurrency, min_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_rate = max_rate
+        self.latency_tolerance = latency_tolerance
+
+        # concurrency limit, grows additively while latencies are
+        # healthy & is halved whenever the node shows it's overloaded
+        self.limit = float(min_concurrency)
+
+        # moving average & best moving average seen, in seconds
+        self.latency = None
+        self.baseline_latency = None
+
+        self.__in_flight = 0
+        self.__decreased_at = 0
+        self.__tokens = float(max_rate or 0)
+        self.__refilled_at = monotonic()
+        self.__condition = Condition()
+
+    def acquire(self):
+        self.__take_token()
+
+        with self.__condition:
+            while self.__in_flight >= int(self.limit):
+                self.__condition.wait()
+            self.__in_flight += 1
+
+        return monotonic()
+
+    def release(self, started_at, overloaded=False):
+        latency = monotonic() - started_at
+
+        with self.__condition:
+            self.__in_flight -= 1
+
+            if overloaded:
+                # only back off once for all the requests that were in flight together
+                if started_at >= self.__decreased_at:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.__decreased_at = monotonic()
+            else:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                self.baseline_latency = min(self.baseline_latency or self.latency, self.latency)
+
+                # only grow when the current limit is actually being used
+                saturated = self.__in_flight + 1 >= int(self.limit)
+                if saturated and latency <= self.baseline_latency * self.latency_tolerance:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+            self.__condition.notify_all()
+
+    def __take_token(self):
+        if not self.max_rate: return
+
+        # token bucket holding up to a second's worth of requests
+        while True:
+            with self.__condition:
+                now = monotonic()
+                self.__tokens = min(max(1, self.max_rate), self.__tokens + (now - self.__refilled_at) * self.max_rate)
+                self.__refilled_at = now
+
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+
+                wait = (1 - self.__tokens) / self.max_rate
+
+            sleep(wait)
@@ -2,7 +2,9 @@ from datetime import datetime
 from functools import lru_cache, wraps
 from json import loads, dumps
 from re import sub
-from time import sleep
+
+from requests import Session
+from requests.adapters import HTTPAdapter
 
 
 # we don't need nanosecond precision here,
@@ -15,16 +17,13 @@ def clean_timestamp(timestamp):
     )
 
 
-def with_retries(func, tries):
-    while tries > 0:
-        try:
-            return func()
-        except:
-            tries -= 1
-            if tries > 0:
-                sleep(0.1)
-                continue
-            raise
+def pooled_session(pool_size):
+    # keeps connections alive & reuses them across requests/threads
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 # Copyright (c) 2017 Pieter Wuille
@@ -23,9 +23,13 @@ setuptools.setup(
     author_email='contact@figment.network',
     url='https://github.com/figment-networks/cosmos-sdk-income-reports',
     install_requires=install_requires,
+    extras_require={'streaming': ['ijson>=3.1']},
     python_requires='>=3.6',
     packages=setuptools.find_packages(),
-    entry_points={'console_scripts': ['cosmos-sdk-income-reports = csir.cli.__main__:main']},
+    entry_points={'console_scripts': [
+        'cosmos-sdk-income-reports = csir.cli.__main__:main',
+        'cosmos-sdk-income-reports-jobs = csir.cli.jobs:main',
+    ]},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Console',
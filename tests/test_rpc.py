@@ -0,0 +1,113 @@
+from base64 import b64encode
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps
+from threading import Thread
+from urllib.parse import urlparse, parse_qs
+import unittest
+
+from csir import Rpc
+
+
+def b64(value):
+    return b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def tx_result(recipient, amount, action='withdraw_delegator_reward', code=0):
+    return {
+        'code': code,
+        'events': [
+            {'type': 'message', 'attributes': [{'key': b64('action'), 'value': b64(action)}]},
+            {'type': 'transfer', 'attributes': [
+                {'key': b64('recipient'), 'value': b64(recipient)},
+                {'key': b64('amount'), 'value': b64(amount)},
+            ]},
+        ],
+    }
+
+
+class StubRpc(BaseHTTPRequestHandler):
+    # path -> function of the query params, returning the result
+    routes = {}
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        self.__class__.requests.append((url.path, params))
+
+        body = dumps({'jsonrpc': '2.0', 'id': -1, 'result': self.__class__.routes[url.path](params)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRpc(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StubRpc)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubRpc.requests = []
+        self.rpc = Rpc(f"http://127.0.0.1:{self.server.server_port}")
+
+    def test_get_transactions_pages_and_bounds_heights(self):
+        pages = {
+            '1': [{'hash': 'A', 'height': '10', 'tx_result': tx_result('cosmos1a', '5uatom')}],
+            '2': [{'hash': 'B', 'height': '12', 'tx_result': tx_result('cosmos1a', '7uatom,3ibc/X', code=5)}],
+        }
+        StubRpc.routes = {'/tx_search': lambda params: {'txs': pages[params['page']], 'total_count': '2'}}
+
+        class PagedRpc(Rpc): per_page = 1
+        rpc = PagedRpc(f"http://127.0.0.1:{self.server.server_port}")
+        txs = rpc.get_transactions({'transfer.recipient': 'cosmos1a'}, min_height=10, max_height=20)
+
+        self.assertEqual([tx.txhash for tx in txs], ['A', 'B'])
+        self.assertEqual(
+            StubRpc.requests[0][1]['query'],
+            "\"transfer.recipient='cosmos1a' AND tx.height>=10 AND tx.height<=20\""
+        )
+        self.assertEqual(len(StubRpc.requests), 2)
+
+        self.assertTrue(txs[0].succeeded)
+        self.assertFalse(txs[1].succeeded)
+        self.assertTrue(txs[0].is_reward_disbursement_type('cosmos'))
+        self.assertEqual(txs[1].transfers(), {'cosmos1a': {'uatom': 7, 'ibc/X': 3}})
+
+    def test_get_block_transactions(self):
+        # tendermint 0.33+
+        StubRpc.routes = {'/block_results': lambda params: {
+            'height': params['height'],
+            'txs_results': [tx_result('cosmos1a', '5uatom'), tx_result('cosmos1b', '2uatom', action='send')],
+        }}
+        txs = self.rpc.get_block_transactions(42)
+
+        self.assertEqual([tx.height for tx in txs], [42, 42])
+        self.assertEqual(txs[0].disbursement('cosmos1a', 'uatom'), 5)
+        self.assertTrue(txs[0].is_reward_disbursement_type('cosmos'))
+        self.assertFalse(txs[1].is_reward_disbursement_type('cosmos'))
+
+    def test_get_block_transactions_tendermint_0_32(self):
+        StubRpc.routes = {'/block_results': lambda params: {
+            'height': params['height'],
+            'results': {'deliver_tx': [tx_result('cosmos1a', '5uatom')]},
+        }}
+        txs = self.rpc.get_block_transactions(42)
+        self.assertEqual(txs[0].transfers(), {'cosmos1a': {'uatom': 5}})
+
+    def test_get_block_transactions_without_txs(self):
+        StubRpc.routes = {'/block_results': lambda params: {'height': params['height'], 'txs_results': None}}
+        self.assertEqual(self.rpc.get_block_transactions(42), [])
+
+
+if __name__ == '__main__': unittest.main()